@@ -0,0 +1,14 @@
+-- Example queries for context["resources"].db.
+-- init_schema runs once, when the database is first used.
+
+-- name: init_schema()#
+create table if not exists visits (
+    page text not null,
+    visited_at real not null
+);
+
+-- name: record_visit(page, visited_at)!
+insert into visits (page, visited_at) values (:page, :visited_at);
+
+-- name: count_visits(page)$
+select count(*) from visits where page = :page;
@@ -0,0 +1,283 @@
+"""
+Benchmarks for the server2.py request pipeline.
+
+Builds a fixture site in a temporary directory, starts server2's
+start_server() on it in a child process and drives each scenario with a
+fixed number of concurrent clients. Results (throughput, p50/p99 latency,
+server RSS) are printed as JSON.
+
+    python benchmark.py                          # run, print JSON
+    python benchmark.py --save-baseline base.json
+    python benchmark.py --baseline base.json     # exit 1 on a regression
+    python benchmark.py --compare-stdlib         # also run the static
+                                                 # scenarios against
+                                                 # http.server
+
+Numbers are only comparable between runs on the same machine.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from aiohttp import ClientSession, TCPConnector
+
+###########################################
+# Fixture Site
+###########################################
+
+SMALL_FILE_SIZE = 1024
+LARGE_FILE_SIZE = 4 * 1024 * 1024
+LISTING_FILES = 2000
+INCLUDE_DEPTH = 5
+ROUTE_TREE_PAGES = 1000
+ROUTE_TREE_DIRS = 10
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with open(path, mode) as f:
+        f.write(content)
+
+def marker_page(count: int) -> str:
+    markers = " ".join(f"{{{{ {i} * 2 }}}}" for i in range(count))
+    return f'print("<p>markers: {markers}</p>")\n'
+
+def build_fixture(base_dir: str):
+    write_file(os.path.join(base_dir, "static", "small.txt"), "s" * SMALL_FILE_SIZE)
+    write_file(os.path.join(base_dir, "static", "large.bin"), os.urandom(LARGE_FILE_SIZE))
+    rows = [{"id": i, "name": f"item {i}", "tags": ["a", "b"]} for i in range(1000)]
+    write_file(os.path.join(base_dir, "data", "data.json"), json.dumps(rows))
+    for i in range(LISTING_FILES):
+        write_file(os.path.join(base_dir, "listing", f"file_{i:05}.txt"), "x")
+    for count in (0, 10, 100):
+        write_file(os.path.join(base_dir, f"page_markers_{count}.py"), marker_page(count))
+    # page_nested.py -> part_1.py -> ... -> part_<INCLUDE_DEPTH>.py
+    write_file(os.path.join(base_dir, "page_nested.py"), 'print("<div>{{ part_1 }}</div>")\n')
+    for level in range(1, INCLUDE_DEPTH + 1):
+        inner = f"{{{{ part_{level + 1} }}}}" if level < INCLUDE_DEPTH else "leaf"
+        write_file(os.path.join(base_dir, f"part_{level}.py"), f'print("<div>{level} {inner}</div>")\n')
+    for i in range(ROUTE_TREE_PAGES):
+        folder = os.path.join(base_dir, "routes", f"d{i % ROUTE_TREE_DIRS}")
+        write_file(os.path.join(folder, f"page_p{i}.py"), f'print("page {i}")\n')
+
+# name -> (URL path, requests, concurrent clients, stdlib comparison?)
+SCENARIOS = {
+    "static_small": ("/static/small.txt", 5000, 32, True),
+    "static_large": ("/static/large.bin", 200, 8, True),
+    "json": ("/data/data.json", 3000, 32, True),
+    "listing": ("/listing", 300, 8, True),
+    "page_markers_0": ("/markers_0", 3000, 32, False),
+    "page_markers_10": ("/markers_10", 3000, 32, False),
+    "page_markers_100": ("/markers_100", 1000, 32, False),
+    "nested_includes": ("/nested", 2000, 32, False),
+    "route_tree_1k": (f"/routes/d{(ROUTE_TREE_PAGES - 1) % ROUTE_TREE_DIRS}/p{ROUTE_TREE_PAGES - 1}", 3000, 32, False),
+}
+
+###########################################
+# Servers
+###########################################
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def serve_pages(base_dir: str, port: int):
+    """
+    Child process body: run server2 on the fixture site.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server2
+    from aiohttp import web
+    server2.BASE_DIR = base_dir
+    web.run_app(server2.start_server(), host="127.0.0.1", port=port, print=None)
+
+def serve_stdlib(base_dir: str, port: int):
+    """
+    Child process body: the standard library's threaded file server.
+    """
+    import functools
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    handler = functools.partial(QuietHandler, directory=base_dir)
+    ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
+
+def start_child(kind: str, base_dir: str) -> tuple:
+    port = free_port()
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", kind, base_dir, str(port)],
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return child, port
+        except OSError:
+            if child.poll() is not None:
+                break
+            time.sleep(0.1)
+    child.kill()
+    raise RuntimeError(f"{kind} server did not start")
+
+def rss_bytes(pid: int):
+    """
+    Resident set size of a process, or None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+###########################################
+# Load Generator
+###########################################
+
+def percentile(sorted_values, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+async def drive(port: int, path: str, requests: int, clients: int) -> dict:
+    """
+    Send `requests` GETs for path from `clients` concurrent connections and
+    return throughput and latency statistics.
+    """
+    url = f"http://127.0.0.1:{port}{path}"
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def client(session):
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            async with session.get(url) as response:
+                await response.read()
+                if response.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    async with ClientSession(connector=TCPConnector(limit=clients)) as session:
+        # Warm up caches and connections.
+        for _ in range(min(clients, requests)):
+            async with session.get(url) as response:
+                await response.read()
+        started = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+def run_scenarios(kind: str, base_dir: str, names, scale: float) -> dict:
+    child, port = start_child(kind, base_dir)
+    results = {}
+    try:
+        for name in names:
+            path, requests, clients, _ = SCENARIOS[name]
+            result = asyncio.run(drive(port, path, max(clients, int(requests * scale)), clients))
+            result["rss_bytes"] = rss_bytes(child.pid)
+            results[name] = result
+            print(f"{kind:7} {name:18} {result['throughput_rps']:>9} req/s  "
+                  f"p50 {result['p50_ms']:>8} ms  p99 {result['p99_ms']:>8} ms", file=sys.stderr)
+    finally:
+        child.terminate()
+        child.wait()
+    return results
+
+###########################################
+# Baselines
+###########################################
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Return a description of every scenario whose throughput fell, or whose
+    p99 latency rose, by more than `tolerance` (a fraction) against the
+    baseline.
+    """
+    regressions = []
+    for name, old in baseline.get("pages", {}).items():
+        new = results["pages"].get(name)
+        if new is None:
+            continue
+        if new["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old['throughput_rps']} -> {new['throughput_rps']} req/s")
+        if new["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {old['p99_ms']} -> {new['p99_ms']} ms")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the server2.py request pipeline.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="run only this scenario (may be repeated)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the number of requests of every scenario")
+    parser.add_argument("--compare-stdlib", action="store_true",
+                        help="also run the static scenarios against http.server")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed regression against the baseline (default 0.15)")
+    parser.add_argument("--output", help="write the results here instead of stdout")
+    parser.add_argument("--serve", nargs=3, metavar=("KIND", "DIR", "PORT"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        kind, base_dir, port = args.serve
+        (serve_pages if kind == "pages" else serve_stdlib)(base_dir, int(port))
+        return 0
+
+    names = args.scenario or list(SCENARIOS)
+    with tempfile.TemporaryDirectory(prefix="pages-bench-") as base_dir:
+        build_fixture(base_dir)
+        results = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pages": run_scenarios("pages", base_dir, names, args.scale),
+        }
+        if args.compare_stdlib:
+            static = [name for name in names if SCENARIOS[name][3]]
+            results["stdlib"] = run_scenarios("stdlib", base_dir, static, args.scale)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
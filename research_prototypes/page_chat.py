@@ -0,0 +1,49 @@
+room = "lobby"
+hub = context["hub"]
+
+print("""<html>
+<head><title>Chat</title></head>
+<body>
+    <h1>{{ context['config']['server_name'] }} Chat</h1>
+""")
+
+print(f"<p>Room <b>{room}</b>, {hub.subscribers(room)} connected.</p>")
+
+print("""
+    <ul id="messages"></ul>
+    <form id="form">
+        <input id="name" placeholder="Name" size="10">
+        <input id="text" placeholder="Message" size="40" autocomplete="off">
+        <input type="submit" value="Send">
+    </form>
+    <script>
+        const messages = document.getElementById("messages");
+        const scheme = location.protocol === "https:" ? "wss://" : "ws://";
+        // Recent history is replayed when the socket opens.
+        const ws = new WebSocket(scheme + location.host + "/hub/""" + room + """/ws");
+        ws.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            const item = document.createElement("li");
+            const data = message.data;
+            item.textContent = typeof data === "object" && data !== null
+                ? (data.name || "anonymous") + ": " + data.text
+                : String(data);
+            messages.appendChild(item);
+        };
+        ws.onclose = () => {
+            const item = document.createElement("li");
+            item.textContent = "(disconnected, reload to rejoin)";
+            messages.appendChild(item);
+        };
+        document.getElementById("form").onsubmit = (event) => {
+            event.preventDefault();
+            const text = document.getElementById("text");
+            const name = document.getElementById("name").value;
+            if (text.value) {
+                ws.send(JSON.stringify({name: name, text: text.value}));
+                text.value = "";
+            }
+        };
+    </script>
+</body>
+</html>""")
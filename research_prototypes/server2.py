@@ -1,10 +1,43 @@
 import os
+import ast
+import builtins
 import re
 import io
 import asyncio
+import ctypes
+import ctypes.util
 import json
 import mimetypes
-from aiohttp import web
+import stat
+import errno
+import gzip
+import zlib
+import html
+import argparse
+import selectors
+import signal
+import socket
+import contextlib
+import copy
+import multiprocessing
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import struct
+import time
+import contextvars
+import functools
+import hashlib
+import marshal
+import importlib.util
+import bisect
+import hmac
+import ipaddress
+import sys
+import threading
+import traceback
+from collections import Counter, OrderedDict, deque
+from aiohttp import web, WSMsgType, WSCloseCode
 
 ###########################################
 # Global Config & Base Directory
@@ -17,278 +50,3577 @@ global_config = {
 # BASE_DIR is the directory where this script resides.
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+# How many compiled page scripts to keep in memory.
+PAGE_CACHE_SIZE = 256
+
+# How many compiled template plans and template markers to keep in memory.
+# Plans are keyed by the page output itself, so they are also limited in
+# total size, and outputs longer than TEMPLATE_CACHE_MAX_TEXT (which mostly
+# differ on every request) are compiled without caching the plan; their
+# markers are still cached one by one.
+TEMPLATE_CACHE_SIZE = 512
+TEMPLATE_CACHE_BYTES = 4 * 1024 * 1024
+TEMPLATE_CACHE_MAX_TEXT = 16 * 1024
+MARKER_CACHE_SIZE = 4096
+
+# How many await markers and includes of one page may be resolved at once.
+MARKER_CONCURRENCY = 8
+
+# Fragment cache limits for pages that call cache(...).
+FRAGMENT_CACHE_SIZE = 1024
+FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+
+# Stream dynamic pages to the client while they render. Admin requests
+# (see is_admin_request) can also opt in with the "?__stream=1" query
+# parameter. Pages rendered in the process pool are never streamed.
+STREAM_PAGES = False
+
+# Static files up to STATIC_CACHE_MAX_FILE bytes are kept in memory, up to
+# STATIC_CACHE_BYTES in total; larger files are sent with sendfile.
+STATIC_CACHE_MAX_FILE = 256 * 1024
+STATIC_CACHE_BYTES = 64 * 1024 * 1024
+
+# Write a .gz sibling next to every compressible static file at startup.
+# Existing .gz siblings are used either way.
+STATIC_PRECOMPRESS = False
+STATIC_COMPRESSIBLE = {".html", ".htm", ".css", ".js", ".json", ".txt", ".svg", ".xml", ".md", ".csv"}
+
+# Compress responses (gzip/deflate) for clients that accept it. Bodies
+# smaller than COMPRESS_MIN_SIZE are sent as they are; bodies larger than
+# COMPRESS_THREAD_SIZE are compressed in a worker thread.
+COMPRESS_RESPONSES = True
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_THREAD_SIZE = 256 * 1024
+COMPRESS_CACHE_BYTES = 16 * 1024 * 1024
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/javascript", "application/xml",
+    "image/svg+xml",
+}
+
+# Directory listings show LISTING_PAGE_SIZE entries per page by default
+# (?offset=&limit= to page, ?sort=name|size|mtime&order=asc|desc to sort).
+# Pages with more than LISTING_STREAM_ROWS rows are streamed to the client.
+LISTING_PAGE_SIZE = 5000
+LISTING_MAX_LIMIT = 50000
+LISTING_STREAM_ROWS = 1000
+LISTING_CACHE_BYTES = 16 * 1024 * 1024
+
+# SQL database for page scripts (context["resources"].db), opened when a
+# page first uses it. Queries are loaded with aiosql from the .sql files in
+# DB_QUERIES_DIR; both folders start with an underscore so they are never
+# served. Relative paths are taken from BASE_DIR when the database opens.
+DB_PATH = os.path.join("_data", "pages.sqlite3")
+DB_QUERIES_DIR = "_queries"
+DB_POOL_SIZE = 4
+# Writes are grouped into one transaction of up to DB_WRITE_BATCH statements.
+DB_WRITE_BATCH = 500
+
+# Pages with a "# page: process" line are rendered in a pool of
+# PROCESS_WORKERS processes instead of on the event loop (0 disables the
+# pool). With PROCESS_PROMOTE_SLOW, so are pages whose own code used more
+# than PROCESS_RENDER_THRESHOLD seconds of CPU in one render.
+# In the pool, context["hub"] is not available, and cache(...) and
+# version(...) have no effect, so such pages are never fragment-cached or
+# answered with a 304 from their version.
+PROCESS_WORKERS = os.cpu_count() or 1
+PROCESS_PROMOTE_SLOW = False
+PROCESS_RENDER_THRESHOLD = 0.25
+
+# Admission control: at most ROUTE_CONCURRENCY renders of one page at a
+# time (a request waits up to ROUTE_QUEUE_TIMEOUT seconds for a slot),
+# renders are cancelled after RENDER_TIMEOUT seconds, and requests get a
+# fast 503 while more than MAX_IN_FLIGHT are being handled or the event
+# loop lags more than MAX_LOOP_LAG seconds.
+ROUTE_CONCURRENCY = 64
+ROUTE_QUEUE_TIMEOUT = 1.0
+RENDER_TIMEOUT = 10.0
+MAX_IN_FLIGHT = 1000
+MAX_LOOP_LAG = 0.5
+LOOP_LAG_INTERVAL = 0.1
+RETRY_AFTER = 1
+
+# A watchdog thread reports (in the log and at /admin/blocking) where the
+# event loop was stuck whenever it is blocked for more than BLOCK_THRESHOLD
+# seconds, e.g. by time.sleep() or heavy work in a page. With
+# BLOCK_QUARANTINE, pages caught blocking are rendered in the process pool
+# from then on.
+BLOCK_WATCHDOG = True
+BLOCK_THRESHOLD = 0.25
+BLOCK_REPORTS = 100
+BLOCK_QUARANTINE = False
+
+# Collect request, render and cache metrics and serve them at /metrics in
+# the Prometheus text format. Off by default (see --metrics); when off the
+# only cost is a flag check in the instrumented functions.
+METRICS_ENABLED = False
+
+# "?__profile=1" renders a page under a sampling profiler, taking a stack
+# sample every PROFILE_INTERVAL seconds. Only admins may use it: requests
+# with an X-Admin-Token header equal to $PAGES_ADMIN_TOKEN or, if that is
+# not set, requests from the local machine that did not come through a
+# proxy (no Forwarded, X-Forwarded-For or X-Real-IP header). Set the token
+# when the server runs behind a reverse proxy.
+PROFILE_INTERVAL = 0.001
+ADMIN_TOKEN = os.environ.get("PAGES_ADMIN_TOKEN")
+
+# Pub/sub hub for pages such as page_chat.py (context["hub"]), served over
+# WebSocket at /hub/<room>/ws and Server-Sent Events at /hub/<room>/events.
+# Each client may have HUB_QUEUE_SIZE messages waiting to be sent; a client
+# that falls further behind is disconnected. The last HUB_HISTORY messages
+# of a room are replayed to new subscribers.
+HUB_QUEUE_SIZE = 256
+HUB_HISTORY = 100
+HUB_MAX_ROOMS = 1000
+HUB_MAX_MESSAGE = 16 * 1024
+HUB_HEARTBEAT = 30.0
+
+# Keep compiled page scripts and template plans in BASE_DIR/__pagecache__
+# across restarts (the folder starts with an underscore, so it is never
+# served), and compile every page and its markers at startup (--warmup)
+# so that the first requests after a deploy do not pay for it. Warming up
+# grows the page cache beyond PAGE_CACHE_SIZE to hold every warmed file.
+PAGE_BYTECODE_CACHE = False
+PAGE_BYTECODE_DIR = "__pagecache__"
+WARMUP_PAGES = False
+
+# Blocking file system calls made while serving requests run on a pool of
+# FS_WORKERS threads; at most FS_MAX_PENDING may be submitted at once, further
+# callers wait on the event loop.
+FS_WORKERS = 8
+FS_MAX_PENDING = 256
+# How long a stat result of a served file may be reused, in seconds; edits
+# show up after at most this long. 0 stats the file on every request.
+FS_STAT_TTL = 0.5
+
+# Results of memoized Resources methods (see @memoize) kept per worker.
+RESOURCE_CACHE_SIZE = 1024
+
+# Seconds between directory scans when inotify is not available.
+ROUTE_POLL_INTERVAL = 2.0
+
 ###########################################
 # File Access Helpers
 ###########################################
 
-def is_path_allowed(rel_path: str) -> bool:
+def is_path_allowed(rel_path: str) -> bool:
+    """
+    Do not allow serving any file or folder whose name starts with a dot or underscore.
+    """
+    parts = rel_path.split(os.sep)
+    for part in parts:
+        if part.startswith(".") or part.startswith("_"):
+            return False
+    return True
+
+class VisibilityTree:
+    """
+    Remembers, per directory, whether the files inside it may be served:
+    every folder name below BASE_DIR is allowed and no folder from there up
+    to BASE_DIR holds a ".private" marker.
+
+    Marker presence is read from the route index listings, so answers for
+    indexed directories cost no syscalls. The index calls invalidate() when
+    a marker appears or disappears, or a directory is removed.
+    """
+    def __init__(self):
+        self.servable = {}
+
+    def is_dir_servable(self, directory: str) -> bool:
+        try:
+            return self.servable[directory]
+        except KeyError:
+            pass
+        if directory == BASE_DIR:
+            result = not self._has_marker(directory)
+        elif not directory.startswith(BASE_DIR + os.sep):
+            return False
+        else:
+            result = (
+                is_path_allowed(os.path.basename(directory))
+                and not self._has_marker(directory)
+                and self.is_dir_servable(os.path.dirname(directory))
+            )
+        if directory in route_index.dirs:
+            # Only cache what the index can keep up to date.
+            self.servable[directory] = result
+        return result
+
+    def invalidate(self, root: str = None):
+        if root is None:
+            self.servable.clear()
+            return
+        prefix = root + os.sep
+        for path in [p for p in self.servable if p == root or p.startswith(prefix)]:
+            del self.servable[path]
+
+    @staticmethod
+    def _has_marker(directory: str) -> bool:
+        record = route_index.dirs.get(directory)
+        if record is not None:
+            return record[3]
+        return os.path.exists(os.path.join(directory, ".private"))
+
+visibility = VisibilityTree()
+
+def can_serve_file(file_path: str) -> bool:
+    if file_path == BASE_DIR:
+        return False
+    return (
+        is_path_allowed(os.path.basename(file_path))
+        and visibility.is_dir_servable(os.path.dirname(file_path))
+    )
+
+def stat_path(path: str):
+    """
+    Return os.stat() of path, or None if it does not exist.
+    """
+    try:
+        return os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+def stat_many(paths) -> list:
+    """
+    os.stat() several paths in one go (None for those that do not exist),
+    so related checks cost a single trip to the file system thread pool.
+    """
+    return [stat_path(path) for path in paths]
+
+def read_text_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+class FileSystemExecutor:
+    """
+    Runs blocking file system calls on a dedicated, bounded thread pool so
+    that a slow disk delays only the requests that wait for it, never the
+    event loop. Keeps counts of queued and running calls for /metrics.
+    """
+    def __init__(self, workers: int = FS_WORKERS, max_pending: int = FS_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.slots = None
+        self.loop = None
+        # Calls submitted and not finished, those of them running in a
+        # thread, and calls finished.
+        self.pending = 0
+        self.running = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+        # Path -> (os.stat() or None, time of the call).
+        self.stats = {}
+
+    @property
+    def queued(self) -> int:
+        return max(self.pending - self.running, 0)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Created lazily, so that forked workers get their own threads.
+            self.loop = loop
+            self.slots = asyncio.Semaphore(self.max_pending)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="pages-fs")
+        self.pending += 1
+        queued_at = time.perf_counter()
+        try:
+            async with self.slots:
+                started_at, result = await loop.run_in_executor(self.executor, self._call, func, args)
+        finally:
+            self.pending -= 1
+            self.calls += 1
+        if METRICS_ENABLED:
+            metrics.observe("pages_fs_wait_seconds", (), started_at - queued_at)
+        return result
+
+    def _call(self, func, args):
+        # Runs in a pool thread.
+        started_at = time.perf_counter()
+        with self.lock:
+            self.running += 1
+        try:
+            return started_at, func(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    async def stat(self, path: str):
+        """
+        os.stat() of path or None, reusing a result up to FS_STAT_TTL old.
+        """
+        return (await self.stat_many((path,)))[0]
+
+    async def stat_many(self, paths) -> list:
+        """
+        stat() several paths; those not recently checked are stat'ed
+        together in a single call on the pool.
+        """
+        now = time.monotonic()
+        results = []
+        missing = []
+        for path in paths:
+            cached = self.stats.get(path)
+            if cached is not None and now - cached[1] < FS_STAT_TTL:
+                results.append(cached[0])
+            else:
+                missing.append(len(results))
+                results.append(None)
+        if missing:
+            fresh = await self.run(stat_many, [paths[i] for i in missing])
+            if FS_STAT_TTL > 0 and len(self.stats) + len(missing) > 4096:
+                self.stats.clear()
+            for i, st in zip(missing, fresh):
+                results[i] = st
+                if FS_STAT_TTL > 0:
+                    self.stats[paths[i]] = (st, now)
+        return results
+
+    def forget(self, path: str):
+        self.stats.pop(path, None)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.loop = None
+
+fs = FileSystemExecutor()
+
+async def stop_file_system(app):
+    fs.shutdown()
+
+def write_new_file(path: str, data: bytes):
+    """
+    Create a file with the given content atomically: it is written to a
+    hidden temporary file in the same folder and then hard-linked into
+    place, so nobody can read it half-written and an existing file is never
+    replaced (FileExistsError). Blocking; run it in an executor. Returns
+    os.stat() of the new file.
+    """
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # No hard links on this filesystem: fall back to a rename, which
+            # is atomic but may replace a file created meanwhile.
+            if os.path.exists(path):
+                raise FileExistsError(path)
+            os.replace(temp_path, path)
+        return os.stat(path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+
+def resolve_file_path(url_path: str) -> str:
+    """
+    Converts a URL path (e.g. "/folder/file.json") to an absolute file system path.
+    Returns None if the path is not within BASE_DIR.
+    """
+    # Remove any query string.
+    url_path = url_path.split("?", 1)[0]
+    if url_path.startswith("/"):
+        url_path = url_path[1:]
+    full_path = os.path.abspath(os.path.join(BASE_DIR, url_path))
+    if not full_path.startswith(BASE_DIR):
+        return None
+    return full_path
+
+# Dynamic index pages first, then some common static index files.
+INDEX_FILES = ("page_home.py", "page_index.py", "index.html", "index.json", "index.zip")
+
+async def get_index_file(directory: str) -> str:
+    """
+    In a directory, look for an index file. (This can be static or dynamic.)
+    For dynamic pages the file must start with "page_" and end with ".py".
+    All candidates are checked with a single batch of stat calls.
+    """
+    candidates = [os.path.join(directory, name) for name in INDEX_FILES]
+    for candidate_path, st in zip(candidates, await fs.stat_many(candidates)):
+        if st is not None and can_serve_file(candidate_path):
+            return candidate_path
+    return None
+
+###########################################
+# Dynamic Page Helpers
+###########################################
+
+def is_page_file(name: str) -> bool:
+    return name.startswith("page_") and name.endswith(".py")
+
+class RouteIndex:
+    """
+    Keeps the dynamic page routes in memory.
+
+    The tree is walked once by build(). After that, only directories reported
+    as changed (by a watcher, or by the admin handlers) are listed again with
+    refresh_dirs(), and the page map is rebuilt from the stored listings.
+    The watchers use the async variants, which list directories on the fs
+    thread pool and only apply the results on the event loop.
+    """
+    def __init__(self):
+        self.base_dir = None
+        # Absolute directory path -> (mtime_ns, page files, subdirectories, has .private)
+        self.dirs = {}
+        # Page name -> path relative to base_dir.
+        self.pages = {}
+        self.routes = ()
+        self.watcher = None
+        # Callbacks taking a file path, called when a file may have changed,
+        # and the files (path -> last known mtime_ns) the polling watcher
+        # should check for them.
+        self.file_listeners = []
+        self.tracked_files = {}
+
+    def build(self, base_dir: str):
+        self.base_dir = base_dir
+        self._replace_tree(self._walk_tree(base_dir))
+
+    async def rebuild_async(self):
+        """
+        build() again with the tree walk run on the fs thread pool.
+        """
+        base_dir = self.base_dir
+        records = await fs.run(self._walk_tree, base_dir)
+        if self.base_dir == base_dir:
+            self._replace_tree(records)
+
+    def _replace_tree(self, records: dict):
+        self.dirs = {}
+        visibility.invalidate()
+        self._scan_tree(self.base_dir, records)
+        self._rebuild()
+
+    def ensure_built(self):
+        if self.base_dir != BASE_DIR:
+            self.build(BASE_DIR)
+
+    def refresh_dirs(self, paths):
+        """
+        List the given directories again, picking up added or removed pages
+        and subdirectories.
+        """
+        paths = self._refreshable(paths)
+        self._apply_scans(self._scan_dirs(paths, {path: self.dirs.get(path) for path in paths}))
+
+    async def refresh_dirs_async(self, paths):
+        """
+        refresh_dirs() with the directory listings run on the fs thread pool.
+        """
+        paths = self._refreshable(paths)
+        if paths:
+            known = {path: self.dirs.get(path) for path in paths}
+            self._apply_scans(await fs.run(self._scan_dirs, paths, known))
+
+    def _refreshable(self, paths) -> list:
+        # Only directories whose parent is indexed can be new.
+        return [path for path in paths if path in self.dirs or os.path.dirname(path) in self.dirs]
+
+    def _scan_dirs(self, paths, known: dict) -> dict:
+        """
+        The blocking part of a refresh: list each path and walk the
+        subdirectories that `known` (path -> record before) did not have.
+        Does not touch the index, so it may run in a thread.
+        """
+        scans = {}
+        for path in paths:
+            record = self._scan_dir(path)
+            subtrees = {}
+            if record is not None:
+                old = known.get(path)
+                old_subdirs = old[2] if old else ()
+                for name in record[2]:
+                    if name not in old_subdirs:
+                        subdir = os.path.join(path, name)
+                        subtrees[subdir] = self._walk_tree(subdir)
+            scans[path] = (record, subtrees)
+        return scans
+
+    def _apply_scans(self, scans: dict):
+        changed = False
+        for path, (record, subtrees) in scans.items():
+            old = self.dirs.get(path)
+            if record is None:
+                self._drop_tree(path)
+                changed = True
+                continue
+            if record == old:
+                continue
+            self.dirs[path] = record
+            if old is None:
+                self._watch(path)
+            elif old[3] != record[3]:
+                # A .private marker was created or deleted.
+                visibility.invalidate(path)
+            old_subdirs = old[2] if old else ()
+            for name in old_subdirs:
+                if name not in record[2]:
+                    self._drop_tree(os.path.join(path, name))
+            for name in record[2]:
+                if name not in old_subdirs:
+                    subdir = os.path.join(path, name)
+                    # Walked now if the index changed since the scan.
+                    self._scan_tree(subdir, subtrees.get(subdir))
+            changed = True
+        if changed:
+            self._rebuild()
+
+    def notify_files(self, paths):
+        for path in paths:
+            for listener in self.file_listeners:
+                listener(path)
+
+    def add_page(self, file_path: str):
+        """
+        Add a page file just created in an indexed directory, without
+        listing the directory again.
+        """
+        directory, name = os.path.split(file_path)
+        if not is_page_file(name):
+            return
+        record = self.dirs.get(directory)
+        if record is None:
+            self.refresh_dirs([directory])
+            return
+        if name not in record[1]:
+            self.dirs[directory] = (record[0], record[1] + (name,), record[2], record[3])
+            page_name = self._page_name(directory, name)
+            if can_serve_file(file_path):
+                self._set_pages({**self.pages, page_name: os.path.relpath(file_path, self.base_dir)})
+
+    def remove_page(self, file_path: str):
+        directory, name = os.path.split(file_path)
+        record = self.dirs.get(directory)
+        if record is None or name not in record[1]:
+            return
+        self.dirs[directory] = (record[0], tuple(n for n in record[1] if n != name), record[2], record[3])
+        pages = dict(self.pages)
+        pages.pop(self._page_name(directory, name), None)
+        self._set_pages(pages)
+
+    def _scan_dir(self, path: str):
+        page_files = []
+        subdirs = []
+        has_private = False
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                for entry in it:
+                    name = entry.name
+                    if name == ".private":
+                        has_private = True
+                    elif entry.is_dir(follow_symlinks=False):
+                        # Hidden folders can never be served, so skip them.
+                        if is_path_allowed(name):
+                            subdirs.append(name)
+                    elif is_page_file(name):
+                        page_files.append(name)
+        except OSError:
+            return None
+        return (mtime_ns, tuple(page_files), tuple(subdirs), has_private)
+
+    def _walk_tree(self, root: str) -> dict:
+        records = {}
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            record = self._scan_dir(path)
+            if record is None:
+                continue
+            records[path] = record
+            for name in reversed(record[2]):
+                stack.append(os.path.join(path, name))
+        return records
+
+    def _scan_tree(self, root: str, records: dict = None):
+        if records is None:
+            records = self._walk_tree(root)
+        for path, record in records.items():
+            self.dirs[path] = record
+            self._watch(path)
+
+    def _drop_tree(self, root: str):
+        prefix = root + os.sep
+        visibility.invalidate(root)
+        for path in [p for p in self.dirs if p == root or p.startswith(prefix)]:
+            del self.dirs[path]
+            if self.watcher is not None:
+                self.watcher.unwatch(path)
+
+    def _watch(self, path: str):
+        if self.watcher is not None:
+            self.watcher.watch(path)
+
+    def _page_name(self, root: str, file: str) -> str:
+        rel_dir = os.path.relpath(root, self.base_dir)
+        # Remove "page_" prefix and ".py" suffix from the file name.
+        base_name = file[len("page_"):-3]
+        # Combine folder path and base name if not in the base folder.
+        if rel_dir != ".":
+            return f"{rel_dir}/{base_name}"
+        return base_name
+
+    def _rebuild(self):
+        pages = {}
+        for root, record in self.dirs.items():
+            for file in record[1]:
+                full_path = os.path.join(root, file)
+                if can_serve_file(full_path):
+                    pages[self._page_name(root, file)] = os.path.relpath(full_path, self.base_dir)
+        self._set_pages(pages)
+
+    def _set_pages(self, pages: dict):
+        # The page map is shared with readers, so it is replaced, never changed.
+        self.pages = pages
+        self.routes = tuple(pages)
+
+route_index = RouteIndex()
+
+# inotify event flags (see inotify(7)).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+class InotifyWatcher:
+    """
+    Tells the route index which directories changed, using Linux inotify.
+    """
+    MASK = (
+        IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_DELETE_SELF | IN_MOVE_SELF
+    )
+    DIR_EVENTS = MASK & ~IN_CLOSE_WRITE
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, index: RouteIndex):
+        self.index = index
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths_by_wd = {}
+        self.wds_by_path = {}
+        self.loop = None
+        # Applies batches of events one at a time, in order.
+        self.updates = asyncio.Lock()
+        self.tasks = set()
+
+    def start(self, loop):
+        self.loop = loop
+        for path in list(self.index.dirs):
+            if not self.watch(path):
+                self.stop()
+                raise OSError("could not add inotify watch for " + path)
+        loop.add_reader(self.fd, self._on_readable)
+
+    def stop(self):
+        if self.fd < 0:
+            return
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+        for task in self.tasks:
+            task.cancel()
+        os.close(self.fd)
+        self.fd = -1
+
+    def watch(self, path: str) -> bool:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            return False
+        self.paths_by_wd[wd] = path
+        self.wds_by_path[path] = wd
+        return True
+
+    def unwatch(self, path: str):
+        wd = self.wds_by_path.pop(path, None)
+        if wd is not None and self.paths_by_wd.get(wd) == path:
+            del self.paths_by_wd[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _on_readable(self):
+        changed = set()
+        files = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                name_start = offset + self.EVENT_HEADER.size
+                offset = name_start + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                path = self.paths_by_wd.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.paths_by_wd[wd]
+                    if self.wds_by_path.get(path) == wd:
+                        del self.wds_by_path[path]
+                if length:
+                    name = data[name_start:offset].rstrip(b"\0")
+                    files.add(os.path.join(path, os.fsdecode(name)))
+                if mask & self.DIR_EVENTS:
+                    changed.add(path)
+        if overflow or changed or files:
+            task = self.loop.create_task(self._update(overflow, sorted(changed), files))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _update(self, overflow: bool, changed: list, files: set):
+        async with self.updates:
+            if overflow:
+                await self.index.rebuild_async()
+                self.index.notify_files(list(self.index.tracked_files))
+                return
+            if changed:
+                await self.index.refresh_dirs_async(changed)
+            if files:
+                self.index.notify_files(files)
+
+class PollingWatcher:
+    """
+    Fallback watcher: periodically compares directory mtimes in a worker
+    thread and refreshes the directories that changed.
+    """
+    def __init__(self, index: RouteIndex, interval: float = ROUTE_POLL_INTERVAL):
+        self.index = index
+        self.interval = interval
+        self.task = None
+
+    def start(self, loop):
+        self.task = loop.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def watch(self, path: str) -> bool:
+        return True
+
+    def unwatch(self, path: str):
+        pass
+
+    @staticmethod
+    def changed_paths(snapshot: dict) -> list:
+        """
+        Return (path, new mtime_ns or None) for every path whose mtime differs
+        from the snapshot. None means the path is gone.
+        """
+        changed = []
+        for path, mtime_ns in snapshot.items():
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime_ns:
+                changed.append((path, current))
+        return changed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            snapshot = {path: record[0] for path, record in self.index.dirs.items()}
+            changed = await fs.run(self.changed_paths, snapshot)
+            if changed:
+                await self.index.refresh_dirs_async([path for path, _ in changed])
+            
+            files = dict(self.index.tracked_files)
+            changed = await fs.run(self.changed_paths, files)
+            if changed:
+                self.index.notify_files([path for path, _ in changed])
+
+def create_route_watcher(index: RouteIndex, loop):
+    """
+    Start watching the indexed tree: inotify where available, polling otherwise.
+    """
+    try:
+        watcher = InotifyWatcher(index)
+        index.watcher = watcher
+        watcher.start(loop)
+    except (OSError, AttributeError, TypeError):
+        watcher = PollingWatcher(index)
+        index.watcher = watcher
+        watcher.start(loop)
+    return watcher
+
+def list_dynamic_pages() -> dict:
+    """
+    Return the page name -> relative path map from the route index.
+    The returned dict is shared; do not modify it.
+    """
+    if METRICS_ENABLED:
+        started = time.perf_counter()
+        route_index.ensure_built()
+        metrics.observe("pages_route_lookup_seconds", (), time.perf_counter() - started)
+    else:
+        route_index.ensure_built()
+    return route_index.pages
+
+def find_dynamic_page(page_name: str) -> str:
+    """
+    Look up a dynamic page by its name. For example, for page_name="about"
+    this looks for a file named "page_about.py" anywhere under BASE_DIR.
+    Returns the absolute path if found; otherwise, None.
+    """
+    rel_path = list_dynamic_pages().get(page_name)
+    if rel_path is not None:
+        return os.path.join(BASE_DIR, rel_path)
+    return None
+
+###########################################
+# Resources for Dynamic Pages
+###########################################
+
+# (method, args) -> task loading that result right now. Finished results
+# are kept in resource_cache (see the Caches section).
+resource_loads = {}
+
+def is_negative_result(result) -> bool:
+    return result is None or (isinstance(result, (str, bytes, tuple, list, dict, set, frozenset)) and not result)
+
+def detached_exception(e: Exception) -> Exception:
+    """
+    Return a copy of e without traceback or chained exceptions. Cached
+    errors are stored and raised as such copies, so that they do not keep
+    the frames of earlier calls alive.
+    """
+    try:
+        e = copy.copy(e)
+    except Exception:
+        # Not copyable; shared as it is.
+        return e
+    e.__traceback__ = e.__context__ = e.__cause__ = None
+    return e
+
+def memoize(ttl: float, stale: float = 0.0, negative_ttl: float = None, error_ttl: float = 1.0):
+    """
+    Cache the results of a Resources coroutine method for all requests of
+    this worker:
+
+    - Concurrent calls with the same arguments share one call of the
+      method instead of each calling the backend.
+    - A result is reused for `ttl` seconds. For `stale` seconds after that
+      it is still returned at once while one call refreshes it in the
+      background; a failed refresh keeps the old result.
+    - Empty results (None, "", [], ...) are kept only briefly, for
+      `negative_ttl` seconds (default `error_ttl`) and never served stale;
+      exceptions for `error_ttl` seconds and re-raised.
+
+    Results are shared between callers, so they should not be modified;
+    prefer returning tuples.
+    """
+    if negative_ttl is None:
+        negative_ttl = error_ttl
+    
+    def decorator(method):
+        name = method.__qualname__
+        
+        def store(key, result, failed):
+            now = time.monotonic()
+            if failed:
+                previous = resource_cache.get(key)
+                if previous is not None and not previous[1] and now < previous[3]:
+                    # Keep serving the stale result rather than the error.
+                    return
+                resource_cache.put(key, (result, True, now + error_ttl, now + error_ttl))
+            else:
+                if is_negative_result(result):
+                    resource_cache.put(key, (result, False, now + negative_ttl, now + negative_ttl))
+                else:
+                    resource_cache.put(key, (result, False, now + ttl, now + ttl + stale))
+        
+        async def load(key, resources, args, kwargs):
+            try:
+                result = await method(resources, *args, **kwargs)
+            except Exception as e:
+                store(key, detached_exception(e), True)
+                raise
+            else:
+                store(key, result, False)
+                return result
+            finally:
+                del resource_loads[key]
+        
+        def start_load(key, resources, args, kwargs):
+            task = asyncio.ensure_future(load(key, resources, args, kwargs))
+            # Background refreshes may fail with nobody awaiting them.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            resource_loads[key] = task
+            return task
+        
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            key = (name, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return await method(self, *args, **kwargs)
+            entry = resource_cache.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if now < entry[3]:
+                    if now >= entry[2] and key not in resource_loads:
+                        start_load(key, self, args, kwargs)
+                    if entry[1]:
+                        raise detached_exception(entry[0])
+                    return entry[0]
+            task = resource_loads.get(key)
+            if task is None:
+                task = start_load(key, self, args, kwargs)
+            # One caller being cancelled must not cancel the shared call.
+            return await asyncio.shield(task)
+        
+        return wrapper
+    return decorator
+
+def list_content_files() -> tuple:
+    content_dir = os.path.join(BASE_DIR, "content")
+    try:
+        names = os.listdir(content_dir)
+    except OSError:
+        return ()
+    return tuple(sorted(name for name in names if is_path_allowed(name)))
+
+class Resources:
+    @memoize(ttl=300, stale=3600, error_ttl=5)
+    async def get_public_ip(self):
+        # In a real server you might query an external service.
+        return "127.0.0.1"
+    
+    async def list_routes(self):
+        # Return the dynamic page names.
+        return list(list_dynamic_pages().keys())
+    
+    @memoize(ttl=5, stale=60, negative_ttl=1)
+    async def list_content(self):
+        # Files in the "content" folder.
+        return await fs.run(list_content_files)
+    
+    @property
+    def db(self):
+        # Shared SQL database, e.g. await context["resources"].db.query("count_visits", page="home")
+        return database
+
+class ConfigView(dict):
+    """
+    Read-only copy of the server configuration given to pages, with
+    attribute access: context.config.server_name.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The page configuration is read-only")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+# Shared by all requests until the configuration changes (see apply_config).
+config_snapshot = None
+
+def config_view() -> ConfigView:
+    global config_snapshot
+    if config_snapshot is None:
+        config_snapshot = ConfigView(global_config)
+    return config_snapshot
+
+class PageContext(dict):
+    """
+    The `context` a page sees. It is a dict, so context["routes"] works,
+    and also allows attribute access (context.routes). The fields in LAZY
+    are only computed when a page first reads them, then kept for the rest
+    of the request; they are not listed by keys() until then.
+    """
+    __slots__ = ()
+    LAZY = {
+        "config": config_view,
+        "resources": lambda: Resources(),
+        "routes": lambda: tuple(list_dynamic_pages()),
+        # Pub/sub rooms, e.g. context["hub"].publish("lobby", {...}).
+        "hub": lambda: hub,
+    }
+
+    def __missing__(self, key):
+        factory = self.LAZY.get(key)
+        if factory is None:
+            raise KeyError(key)
+        value = self[key] = factory()
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.LAZY
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+###########################################
+# SQL Database for Dynamic Pages
+###########################################
+
+class Database:
+    """
+    Pooled SQLite access for page scripts, built on aiosql and aiosqlite.
+
+    Opened on first use, when queries are loaded from DB_QUERIES_DIR. Reads borrow one
+    of DB_POOL_SIZE long-lived connections, whose sqlite3 statement caches
+    keep prepared statements between requests. Writes go through a single
+    writer that groups the writes queued by concurrent requests into one
+    transaction, instead of one commit per INSERT.
+    """
+    def __init__(self, path, queries_dir, pool_size):
+        self.path = path
+        self.queries_dir = queries_dir
+        self.pool_size = pool_size
+        self.queries = None
+        self.pool = None
+        self.writer = None
+        self.write_queue = None
+        self.writer_task = None
+        self.error = None
+        self.opening = None
+
+    async def ensure_open(self):
+        """
+        Open the database unless it is open already; concurrent callers
+        share one attempt.
+        """
+        if self.pool is not None:
+            return
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self.open())
+        try:
+            await asyncio.shield(self.opening)
+        finally:
+            if self.opening is not None and self.opening.done():
+                self.opening = None
+        if self.pool is None:
+            raise RuntimeError(self.error or "database is not open")
+
+    async def open(self):
+        try:
+            import aiosql
+            import aiosqlite
+        except ImportError as e:
+            self.error = f"database support needs aiosql and aiosqlite ({e})"
+            return
+        path = os.path.join(BASE_DIR, self.path)
+        queries_dir = os.path.join(BASE_DIR, self.queries_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.isdir(queries_dir):
+            self.queries = aiosql.from_path(queries_dir, "aiosqlite")
+        
+        async def connect():
+            conn = await aiosqlite.connect(path, cached_statements=256)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            return conn
+        
+        connections = []
+        try:
+            self.writer = await connect()
+            if self.queries is not None and hasattr(self.queries, "init_schema"):
+                await self.queries.init_schema(self.writer)
+                await self.writer.commit()
+            for _ in range(self.pool_size):
+                connections.append(await connect())
+        except Exception:
+            for conn in connections:
+                await conn.close()
+            if self.writer is not None:
+                await self.writer.close()
+                self.writer = None
+            raise
+        self.pool = asyncio.Queue()
+        for conn in connections:
+            self.pool.put_nowait(conn)
+        self.write_queue = asyncio.Queue()
+        self.writer_task = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.writer_task
+            self.writer_task = None
+        if self.pool is not None:
+            while not self.pool.empty():
+                await self.pool.get_nowait().close()
+            self.pool = None
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    async def _query(self, name):
+        await self.ensure_open()
+        query = getattr(self.queries, name, None) if self.queries is not None else None
+        if query is None:
+            raise KeyError(f"no query named {name!r} in {self.queries_dir}")
+        return query
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """
+        Borrow a pooled connection, waiting if all of them are in use.
+        """
+        await self.ensure_open()
+        conn = await self.pool.get()
+        try:
+            yield conn
+        finally:
+            self.pool.put_nowait(conn)
+
+    async def query(self, name, **params):
+        """
+        Run a named read query on a pooled connection and return its result.
+        """
+        query = await self._query(name)
+        async with self.connection() as conn:
+            return await query(conn, **params)
+
+    async def write(self, name, **params):
+        """
+        Queue a named INSERT/UPDATE/DELETE and wait until it is committed.
+        """
+        query = await self._query(name)
+        if self.writer_task is None or self.writer_task.done():
+            raise RuntimeError(self.error or "database writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        self.write_queue.put_nowait((query.sql, params, future))
+        return await future
+
+    async def _write_loop(self):
+        batch = []
+        try:
+            while True:
+                batch = [await self.write_queue.get()]
+                # Let the other requests that are ready run, so their writes
+                # join this transaction.
+                await asyncio.sleep(0)
+                while len(batch) < DB_WRITE_BATCH and not self.write_queue.empty():
+                    batch.append(self.write_queue.get_nowait())
+                try:
+                    await self._commit_batch(batch)
+                except Exception:
+                    await self.writer.rollback()
+                    # Find the failing statements by running them one by one.
+                    for item in batch:
+                        try:
+                            await self._commit_batch([item])
+                        except Exception as e:
+                            await self.writer.rollback()
+                            if not item[2].done():
+                                item[2].set_exception(e)
+        except Exception as e:
+            # E.g. a failed rollback; write() refuses new writes from now on.
+            self.error = f"database writer stopped: {e!r}"
+            print(f"WARNING: {self.error}", file=sys.stderr)
+        finally:
+            # Nobody would ever complete these.
+            while not self.write_queue.empty():
+                batch.append(self.write_queue.get_nowait())
+            for item in batch:
+                if not item[2].done():
+                    item[2].set_exception(RuntimeError(self.error or "database is closed"))
+
+    async def _commit_batch(self, batch):
+        # Consecutive writes of the same statement go through executemany.
+        start = 0
+        while start < len(batch):
+            sql = batch[start][0]
+            end = start
+            while end < len(batch) and batch[end][0] == sql:
+                end += 1
+            await self.writer.executemany(sql, [item[1] for item in batch[start:end]])
+            start = end
+        await self.writer.commit()
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+database = Database(DB_PATH, DB_QUERIES_DIR, DB_POOL_SIZE)
+
+async def close_database(app):
+    await database.close()
+
+###########################################
+# Caches
+###########################################
+
+class LRUCache:
+    """
+    A small mapping with least-recently-used eviction and hit/miss counters.
+    If max_bytes is given, sizeof(value) is also kept under that total.
+    on_evict(key, value) is called for every entry dropped to make room.
+    """
+    def __init__(self, max_entries=256, max_bytes=None, sizeof=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.sizeof is not None:
+            old = self.entries.get(key)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self.size += self.sizeof(value)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries or (
+            self.max_bytes is not None and self.size > self.max_bytes and len(self.entries) > 1
+        ):
+            evicted_key, evicted = self.entries.popitem(last=False)
+            if self.sizeof is not None:
+                self.size -= self.sizeof(evicted)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted)
+
+    def pop(self, key, default=None):
+        value = self.entries.pop(key, default)
+        if value is not default and self.sizeof is not None:
+            self.size -= self.sizeof(value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# Compiled page scripts, keyed by absolute path. Each entry holds the file
+# identity (inode, mtime, size) it was compiled from, so an edited file is
+# recompiled on its next request, the code and the page's "# page:" options.
+page_cache = LRUCache(PAGE_CACHE_SIZE)
+
+# Results of @memoize'd Resources methods, keyed by (method, args):
+# (result or exception, failed, fresh until, stale until).
+resource_cache = LRUCache(RESOURCE_CACHE_SIZE)
+
+def file_signature(st) -> tuple:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def wrap_page_source(source: str) -> str:
+    """
+    Wrap a page script in an async function so that it may use await.
+    """
+    lines = ["async def __template_main__():"]
+    lines.extend("    " + line for line in source.splitlines())
+    lines.append("    pass")
+    return "\n".join(lines) + "\n"
+
+def parse_page_source(source: str, file_path: str):
+    """
+    Parse a wrapped page script, shifting the positions of the body back
+    so that tracebacks and profiles show the line and column numbers of the
+    page file itself rather than of the wrapper.
+    """
+    tree = ast.parse(wrap_page_source(source), file_path)
+    wrapper = tree.body[0]
+    for statement in wrapper.body:
+        for node in ast.walk(statement):
+            if "lineno" in node._attributes:
+                node.lineno -= 1
+                node.end_lineno -= 1
+                node.col_offset -= 4
+                node.end_col_offset -= 4
+    return tree
+
+def compile_page(file_path: str):
+    """
+    Return the compiled code object for a page script, compiling it only if
+    the file changed since the cached copy was made. Blocking; on the
+    request path use load_page().
+    """
+    signature = file_signature(os.stat(file_path))
+    code = cached_page_code(file_path, signature)
+    if code is not None:
+        return code
+    return compile_page_source(file_path, signature, read_text_file(file_path))
+
+def compile_page_source(file_path: str, signature: tuple, source: str):
+    """
+    The part of compile_page() after the source was read: use the
+    persistent cache if enabled, otherwise compile.
+    """
+    code = load_page_bytecode(file_path, source) if PAGE_BYTECODE_CACHE else None
+    if code is None:
+        code = store_page(file_path, signature, source)
+        if PAGE_BYTECODE_CACHE:
+            save_page_bytecode(file_path, source, code)
+        return code
+    return store_page(file_path, signature, source, code)
+
+async def load_page(file_path: str):
+    """
+    compile_page() with the file system calls run on the fs thread pool.
+    """
+    st = await fs.stat(file_path)
+    if st is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), file_path)
+    signature = file_signature(st)
+    code = cached_page_code(file_path, signature)
+    if code is not None:
+        return code
+    source = await fs.run(read_text_file, file_path)
+    code = await fs.run(load_page_bytecode, file_path, source) if PAGE_BYTECODE_CACHE else None
+    if code is None:
+        code = store_page(file_path, signature, source)
+        if PAGE_BYTECODE_CACHE:
+            await fs.run(save_page_bytecode, file_path, source, code)
+        return code
+    return store_page(file_path, signature, source, code)
+
+def cached_page_code(file_path: str, signature: tuple):
+    cached = page_cache.get(file_path)
+    if cached is None:
+        return None
+    if cached[0] == signature:
+        return cached[1]
+    # The file changed: forget what its previous version declared and
+    # drop cached output that embeds it.
+    forget_page(file_path)
+    return None
+
+def store_page(file_path: str, signature: tuple, source: str, code=None):
+    if code is None:
+        code = compile(parse_page_source(source, file_path), file_path, "exec")
+    page_cache.put(file_path, (signature, code, page_directives(source)))
+    return code
+
+def forget_page(file_path: str):
+    """
+    Drop everything known about a page that was changed or deleted.
+    """
+    fs.forget(file_path)
+    page_cache.pop(file_path)
+    page_env_cache.pop(file_path)
+    page_policies.pop(file_path, None)
+    page_versions.pop(file_path, None)
+    page_headers.pop(file_path, None)
+    slow_pages.discard(file_path)
+    fragment_cache.invalidate_file(file_path)
+
+def page_directives(source: str) -> frozenset:
+    """
+    Read options from "# page: ..." comment lines at the top of a page,
+    e.g. "# page: process" to render it in the process pool.
+    """
+    options = set()
+    for line in source.splitlines():
+        line = line.strip()
+        if not line.startswith("#"):
+            break
+        name, _, value = line[1:].partition(":")
+        if name.strip() == "page":
+            options.update(option.strip() for option in value.split(",") if option.strip())
+    return frozenset(options)
+
+###########################################
+# Templating Engine for Dynamic Pages
+###########################################
+
+import os
+# Make sure BASE_DIR is defined globally (it is in our full server code)
+# from earlier: BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+import os
+
+# Ensure BASE_DIR is defined globally.
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+import os
+
+# Assume BASE_DIR is defined as the server script's directory.
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+TEMPLATE_PATTERN = re.compile(r"\{\{\s*(.*?)\s*\}\}", re.DOTALL)
+
+def template_plan_size(plan: tuple) -> int:
+    # The literal text, counted twice as the key holds the whole template.
+    return 2 * sum(len(item) for item in plan if isinstance(item, str)) + 64 * len(plan)
+
+# Compiled template plans, keyed by (page directory, template text).
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_BYTES, sizeof=template_plan_size)
+# Compiled marker segments, keyed by (page directory, marker text).
+marker_cache = LRUCache(MARKER_CACHE_SIZE)
+
+def compile_marker(code: str, page_dir: str) -> tuple:
+    """
+    Classify a single {{ ... }} marker and compile it into a plan segment:
+      - ("include", relative_path, candidate) for file references,
+      - ("expr", code, code_object) for Python expressions,
+      - ("await", code, code_object) for awaited expressions,
+      - ("error", message) if the expression does not compile.
+
+    File references:
+      - Markers starting with ".\\" are relative to BASE_DIR.
+      - Markers starting with "./" are relative to the current page's directory.
+      - Markers starting with "..\\" or "../" allow upward traversal (relative to BASE_DIR or the current page dir).
+      - Markers that simply end with ".py" (for example, "page_home_footer.py")
+        are relative to the current page's directory.
+    """
+    key = (page_dir, code)
+    segment = marker_cache.get(key)
+    if segment is not None:
+        return segment
+    
+    candidate = None  # Candidate file's absolute path
+    if code.startswith(".\\"):
+        # Example: ".\pages\page_home_footer"
+        relative_path = code[2:]
+        candidate = os.path.abspath(os.path.join(BASE_DIR, relative_path))
+    elif code.startswith("./"):
+        # Example: "./page_home_footer"
+        relative_path = code[2:]
+        candidate = os.path.abspath(os.path.join(page_dir, relative_path))
+    elif code.startswith("..\\"):
+        # Example: "..\subfolder\somefile"
+        relative_path = code  # Keep the "..\\" in the path.
+        candidate = os.path.abspath(os.path.join(BASE_DIR, relative_path))
+    elif code.startswith("../") or code.endswith(".py"):
+        # Example: "../subfolder/somefile" or "page_home_footer.py"
+        relative_path = code
+        candidate = os.path.abspath(os.path.join(page_dir, relative_path))
+    
+    if candidate is not None:
+        segment = ("include", relative_path, candidate)
+    else:
+        try:
+            if code.startswith("await "):
+                segment = ("await", code, compile(code[6:].strip(), "<template>", "eval"))
+            else:
+                segment = ("expr", code, compile(code, "<template>", "eval"))
+        except SyntaxError as e:
+            segment = ("error", f"[Error: {e}]")
+    marker_cache.put(key, segment)
+    return segment
+
+def compile_template(template_str: str, page_dir: str) -> tuple:
+    """
+    Turn page output into a render plan: a tuple whose items are either
+    literal strings or marker segments from compile_marker().
+    """
+    cacheable = len(template_str) <= TEMPLATE_CACHE_MAX_TEXT
+    key = (page_dir, template_str)
+    plan = template_cache.get(key) if cacheable else None
+    if plan is not None:
+        return plan
+    plan = []
+    last = 0
+    for m in TEMPLATE_PATTERN.finditer(template_str):
+        if m.start() > last:
+            plan.append(template_str[last:m.start()])
+        plan.append(compile_marker(m.group(1).strip(), page_dir))
+        last = m.end()
+    if last < len(template_str):
+        plan.append(template_str[last:])
+    plan = tuple(plan)
+    if cacheable:
+        template_cache.put(key, plan)
+    return plan
+
+async def include_page(candidate, relative_path, env):
+    """
+    Render an included page and process its own template markers.
+    """
+    # Security check: Ensure candidate is within BASE_DIR.
+    if candidate.startswith(BASE_DIR):
+        try:
+            # Render the included file and its own template markers.
+            if METRICS_ENABLED:
+                started = time.perf_counter()
+                text = await render_fragment(candidate, env["context"])
+                metrics.observe("pages_include_seconds", (metrics.page_label(candidate),), time.perf_counter() - started)
+                return text
+            return await render_fragment(candidate, env["context"])
+        except FileNotFoundError as e:
+            if e.filename != candidate:
+                return f"[Error including file '{relative_path}': {e}]"
+        except Exception as e:
+            return f"[Error including file '{relative_path}': {e}]"
+    return f"[Error: File '{relative_path}' not found or access denied]"
+
+async def resolve_marker(segment, env) -> str:
+    trace = profile_trace.get()
+    if not METRICS_ENABLED and trace is None:
+        return await evaluate_marker(segment, env)
+    labels = metrics.marker_labels(segment, env)
+    started = time.perf_counter()
+    result = await evaluate_marker(segment, env)
+    elapsed = time.perf_counter() - started
+    if trace is not None:
+        trace.append((segment[0],) + labels + (elapsed,))
+    if METRICS_ENABLED:
+        metrics.observe("pages_marker_seconds", labels, elapsed)
+        if result.startswith("[Error"):
+            metrics.count("pages_marker_errors_total", labels)
+    return result
+
+async def evaluate_marker(segment, env) -> str:
+    kind = segment[0]
+    if kind == "include":
+        return await include_page(segment[2], segment[1], env)
+    if kind == "error":
+        return segment[1]
+    code = segment[1]
+    try:
+        if kind == "await":
+            result = await eval(segment[2], env)
+        else:
+            result = eval(segment[2], env)
+    except NameError as ne:
+        # Fallback: if the marker is a bare identifier, try to include a file with that name.
+        if code.isidentifier():
+            page_dir = env.get("__page_dir__", BASE_DIR)
+            candidate = os.path.join(page_dir, f"{code}.py")
+            try:
+                result = await render_fragment(candidate, env["context"])
+            except FileNotFoundError as e:
+                if e.filename != candidate:
+                    raise
+                result = f"[Error: {ne}]"
+        else:
+            result = f"[Error: {ne}]"
+    except Exception as e:
+        result = f"[Error: {e}]"
+    return str(result)
+
+async def render_plan(plan, env) -> str:
+    """
+    Execute a template plan. Plain expressions are evaluated in place;
+    await markers, includes and bare identifiers (which may fall back to an
+    include) are independent of each other, so they are
+    resolved concurrently (at most MARKER_CONCURRENCY at a time per page)
+    and their results are put back in plan order.
+    """
+    parts = []
+    waiting = []
+    for segment in plan:
+        if segment.__class__ is str:
+            parts.append(segment)
+        elif segment[0] == "error" or (segment[0] == "expr" and not segment[1].isidentifier()):
+            parts.append(await resolve_marker(segment, env))
+        else:
+            waiting.append((len(parts), segment))
+            parts.append(None)
+    if len(waiting) == 1:
+        index, segment = waiting[0]
+        parts[index] = await resolve_marker(segment, env)
+    elif waiting:
+        limit = asyncio.Semaphore(MARKER_CONCURRENCY)
+        
+        async def resolve_limited(segment):
+            async with limit:
+                return await resolve_marker(segment, env)
+        
+        results = await asyncio.gather(*(resolve_limited(segment) for _, segment in waiting))
+        for (index, _), result in zip(waiting, results):
+            parts[index] = result
+    return "".join(parts)
+
+async def process_template(template_str, env):
+    """
+    Processes template markers of the form {{ ... }}.
+    
+    The template is compiled once into a plan (see compile_template) and the
+    plan is cached, so rendering the same output again only executes it.
+    File-reference markers include and render that file; other markers are
+    evaluated as Python expressions (with a fallback to include a file if a
+    bare identifier is missing).
+    """
+    if "{{" not in template_str:
+        return template_str
+    plan = compile_template(template_str, env.get("__page_dir__", BASE_DIR))
+    return await render_plan(plan, env)
+
+# Per page file, the globals every render of it starts from (see make_page_env).
+page_env_cache = LRUCache(PAGE_CACHE_SIZE)
+
+async def no_flush():
+    pass
+
+def page_env_base(file_path) -> dict:
+    base = page_env_cache.get(file_path)
+    if base is None:
+        base = {
+            "__builtins__": builtins,
+            "debug": print,
+            # Only waits for the client when the page is streamed.
+            "flush": no_flush,
+            "cache": functools.partial(declare_cache, file_path),
+            "version": functools.partial(declare_version, file_path),
+            # Save the directory where the page resides to support includes.
+            "__page_dir__": os.path.dirname(file_path),
+            "__file__": file_path,
+        }
+        page_env_cache.put(file_path, base)
+    return base
+
+def make_page_env(file_path, context, output) -> dict:
+    """
+    Build the globals a page script runs in: a copy of the page's shared
+    base globals plus the request's context. print() and show() write to
+    the given file-like output; debug() is the real print().
+    """
+    env = page_env_base(file_path).copy()
+    env["context"] = context
+    env["print"] = env["show"] = functools.partial(print, file=output)
+    return env
+
+async def render_page(file_path, context):
+    """
+    Load a dynamic page (a .py file whose name starts with "page_"),
+    wrap its source in an async function (to allow await), and capture its output.
+    """
+    code = await load_page(file_path)
+    output = io.StringIO()
+    env = make_page_env(file_path, context, output)
+    exec(code, env)
+    if METRICS_ENABLED:
+        started = time.perf_counter()
+        await env["__template_main__"]()
+        metrics.observe("pages_render_seconds", (metrics.page_label(file_path),), time.perf_counter() - started)
+    else:
+        await env["__template_main__"]()
+    return output.getvalue(), env
+
+###########################################
+# Persistent Page Cache
+###########################################
+
+# Cache files start with the interpreter's bytecode magic number and a
+# version of the way pages are wrapped, so that neither an upgrade nor a
+# change here can load incompatible code.
+BYTECODE_HEADER = importlib.util.MAGIC_NUMBER + b"pages1"
+
+def bytecode_dir() -> str:
+    return os.path.join(BASE_DIR, PAGE_BYTECODE_DIR)
+
+def bytecode_path(file_path: str) -> str:
+    name = hashlib.blake2b(file_path.encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(bytecode_dir(), name + ".pagec")
+
+def source_hash(source: str) -> bytes:
+    return hashlib.blake2b(source.encode("utf-8"), digest_size=16).digest()
+
+def write_cache_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_path)
+        raise
+
+def load_page_bytecode(file_path: str, source: str):
+    """
+    Return the cached code object of a page, or None if there is none for
+    this exact source and Python version.
+    """
+    try:
+        with open(bytecode_path(file_path), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    header = BYTECODE_HEADER + source_hash(source)
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+def save_page_bytecode(file_path: str, source: str, code):
+    try:
+        write_cache_file(bytecode_path(file_path), BYTECODE_HEADER + source_hash(source) + marshal.dumps(code))
+    except OSError:
+        pass
+
+def load_template_plans():
+    """
+    Fill the template and marker caches with what save_template_plans()
+    saved. Both are keyed by the template or marker text itself, so they
+    need no other validation than the Python version.
+    """
+    try:
+        with open(os.path.join(bytecode_dir(), "templates.pagec"), "rb") as f:
+            data = f.read()
+        if not data.startswith(BYTECODE_HEADER):
+            return
+        plans, markers = marshal.loads(data[len(BYTECODE_HEADER):])
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+    for page_dir, code, segment in markers:
+        marker_cache.put((page_dir, code), segment)
+    for page_dir, template_str, plan in plans:
+        template_cache.put((page_dir, template_str), plan)
+
+def save_template_plans():
+    plans = [key + (plan,) for key, plan in template_cache.entries.items()]
+    markers = [key + (segment,) for key, segment in marker_cache.entries.items()]
+    try:
+        write_cache_file(
+            os.path.join(bytecode_dir(), "templates.pagec"),
+            BYTECODE_HEADER + marshal.dumps((plans, markers)),
+        )
+    except (OSError, ValueError):
+        pass
+
+def warm_up_pages() -> int:
+    """
+    Compile every page, the markers written in its source and the files
+    those markers include. Returns the number of files compiled.
+    """
+    compiled = set()
+    pending = [os.path.join(BASE_DIR, rel_path) for rel_path in list_dynamic_pages().values()]
+    while pending:
+        file_path = pending.pop()
+        if file_path in compiled:
+            continue
+        # Evicting earlier pages to make room would undo the warm-up.
+        page_cache.max_entries = max(page_cache.max_entries, len(compiled) + 1)
+        try:
+            st = os.stat(file_path)
+            source = read_text_file(file_path)
+            signature = file_signature(st)
+            if cached_page_code(file_path, signature) is None:
+                compile_page_source(file_path, signature, source)
+        except (OSError, SyntaxError, ValueError, UnicodeDecodeError):
+            continue
+        compiled.add(file_path)
+        page_dir = os.path.dirname(file_path)
+        for m in TEMPLATE_PATTERN.finditer(source):
+            segment = compile_marker(m.group(1).strip(), page_dir)
+            if segment[0] == "include" and segment[2].startswith(BASE_DIR) and os.path.isfile(segment[2]):
+                pending.append(segment[2])
+    return len(compiled)
+
+async def open_page_cache(app):
+    if PAGE_BYTECODE_CACHE:
+        load_template_plans()
+    if WARMUP_PAGES:
+        # Runs before the server starts accepting connections.
+        started = time.perf_counter()
+        count = warm_up_pages()
+        print(f"Warmed up {count} page files in {time.perf_counter() - started:.2f}s")
+
+async def close_page_cache(app):
+    if PAGE_BYTECODE_CACHE:
+        save_template_plans()
+
+###########################################
+# Streaming Page Output
+###########################################
+
+class PageStream:
+    """
+    File-like sink for page output in streaming mode. Writes are buffered
+    until the response writer takes them. print() cannot wait, so pages
+    that print a lot should call `await flush()` now and then: it returns
+    once everything printed so far has been written to the client, which
+    keeps the buffer small for slow clients.
+    """
+    def __init__(self):
+        self.buffer = []
+        self.ready = asyncio.Event()
+        self.sent = asyncio.Event()
+        self.sent.set()
+        self.closed = False
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.ready.set()
+        self.sent.clear()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    async def drain(self):
+        await self.sent.wait()
+
+    def take(self) -> str:
+        text = "".join(self.buffer)
+        self.buffer.clear()
+        self.ready.clear()
+        return text
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        self.sent.set()
+
+def template_safe_cut(text: str) -> int:
+    """
+    Return how much of text can be template-processed now without splitting
+    a {{ ... }} marker whose end has not been printed yet.
+    """
+    start = text.rfind("{{")
+    if start != -1 and text.find("}}", start) == -1:
+        return start
+    if text.endswith("{"):
+        return len(text) - 1
+    return len(text)
+
+async def stream_page(request, file_path, context):
+    """
+    Render a dynamic page straight into a chunked StreamResponse.
+
+    The page runs as a task. Whenever it yields (at an await) or finishes,
+    the output printed so far is template-processed up to the last complete
+    marker and written to the client; response.write() waits for the
+    transport to drain, so a slow client slows the writer down.
+    """
+    code = await load_page(file_path)
+    stream = PageStream()
+    env = make_page_env(file_path, context, stream)
+    env["flush"] = stream.drain
+    exec(code, env)
+    
+    response = web.StreamResponse(headers={"Content-Type": "text/html; charset=utf-8"})
+    response.enable_chunked_encoding()
+    if COMPRESS_RESPONSES:
+        response.enable_compression()
+    await response.prepare(request)
+    
+    page = asyncio.ensure_future(env["__template_main__"]())
+    page.add_done_callback(lambda _: stream.close())
+    # The response has started, so a timeout can only stop the page.
+    timer = asyncio.get_running_loop().call_later(RENDER_TIMEOUT, page.cancel)
+    pending = ""
+    try:
+        while True:
+            await stream.ready.wait()
+            done = stream.closed
+            pending += stream.take()
+            cut = len(pending) if done else template_safe_cut(pending)
+            if cut:
+                chunk = await process_template(pending[:cut], env)
+                pending = pending[cut:]
+                await response.write(chunk.encode("utf-8"))
+            if not stream.buffer:
+                stream.sent.set()
+            if done:
+                break
+        if page.cancelled():
+            await response.write(b"Page render timed out")
+        elif page.exception() is not None:
+            await response.write(f"Error rendering page: {page.exception()}".encode("utf-8"))
+    finally:
+        timer.cancel()
+        if not page.done():
+            page.cancel()
+    await response.write_eof()
+    return response
+
+###########################################
+# Fragment Cache
+###########################################
+
+# What each page declared by calling cache(...) or version(...) during its
+# last render, keyed by absolute path. Cleared when the page file changes.
+page_policies = {}
+page_versions = {}
+# Response headers set through context["headers"] on the last render of a
+# page with a version, for answering 304s without rendering.
+page_headers = {}
+
+# The set collecting files rendered for the fragment currently being built.
+fragment_deps = contextvars.ContextVar("fragment_deps", default=None)
+
+def declare_cache(file_path, ttl=None, vary=()):
+    """
+    Called by page scripts as cache(ttl=..., vary=[...]) to let their
+    rendered output (including includes) be reused. ttl is in seconds (None
+    keeps the output until a file it depends on changes); vary lists
+    expressions evaluated against the context, e.g.
+    "context['config']['server_name']", whose values become part of the key.
+    """
+    page_policies[file_path] = {
+        "ttl": ttl,
+        "vary": tuple(compile(expr, "<vary>", "eval") for expr in vary),
+    }
+
+def declare_version(file_path, expr):
+    """
+    Called by page scripts as version("expr") to name an expression,
+    evaluated against the context, that changes whenever the page output
+    does. Later requests then get an ETag from the page source and that
+    value without rendering, so a matching If-None-Match skips the render.
+    """
+    page_versions[file_path] = compile(expr, "<version>", "eval")
+
+class FragmentCache:
+    """
+    Rendered output of cacheable pages and includes, with size-bounded LRU
+    eviction and a reverse dependency graph: every entry records which files
+    were rendered to produce it, so a change to any of them (e.g. a shared
+    footer) drops all entries that embed it.
+    """
+    def __init__(self, max_entries, max_bytes):
+        # Key -> (text, expires_at or None, dependency paths, response headers)
+        self.entries = LRUCache(
+            max_entries, max_bytes, sizeof=lambda entry: len(entry[0]), on_evict=self._unlink,
+        )
+        # File path -> keys of entries depending on it.
+        self.dependents = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            self._drop(key)
+            return None
+        return entry
+
+    def put(self, key, text, ttl, deps, headers):
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.entries.put(key, (text, expires_at, deps, headers))
+        for path in deps:
+            self.dependents.setdefault(path, set()).add(key)
+            if path not in route_index.tracked_files:
+                compiled = page_cache.entries.get(path)
+                route_index.tracked_files[path] = compiled[0][1] if compiled else None
+
+    def invalidate_file(self, path):
+        keys = self.dependents.get(path)
+        if keys:
+            for key in list(keys):
+                self._drop(key)
+        # Also forgets a file whose entries are all gone already.
+        self.dependents.pop(path, None)
+        route_index.tracked_files.pop(path, None)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        if entry is not None:
+            self._unlink(key, entry)
+
+    def _unlink(self, key, entry):
+        # Remove an entry that left the cache from the dependency graph, and
+        # stop watching files no remaining entry depends on.
+        for path in entry[2]:
+            keys = self.dependents.get(path)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[path]
+                    route_index.tracked_files.pop(path, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.dependents.clear()
+        route_index.tracked_files.clear()
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_BYTES)
+route_index.file_listeners.append(fragment_cache.invalidate_file)
+route_index.file_listeners.append(fs.forget)
+
+def fragment_key(file_path, context):
+    policy = page_policies.get(file_path)
+    if policy is None:
+        return None, None
+    try:
+        key = (file_path,) + tuple(eval(code, {"context": context}) for code in policy["vary"])
+        hash(key)
+    except Exception:
+        return None, policy
+    return key, policy
+
+async def render_fragment(file_path, context) -> str:
+    """
+    Render a page together with its template markers. Pages that declared
+    cache(...) are served from the fragment cache when possible.
+    """
+    parent_deps = fragment_deps.get()
+    key, policy = fragment_key(file_path, context)
+    if key is not None:
+        entry = fragment_cache.get(key)
+        if entry is not None:
+            if parent_deps is not None:
+                parent_deps.update(entry[2])
+            if entry[3]:
+                # Re-apply the response headers the render had set.
+                context["headers"].update(entry[3])
+            return entry[0]
+    
+    deps = {file_path}
+    token = fragment_deps.set(deps)
+    try:
+        output, env = await render_page(file_path, context)
+        if METRICS_ENABLED:
+            started = time.perf_counter()
+            text = await process_template(output, env)
+            metrics.observe("pages_template_seconds", (metrics.page_label(file_path),), time.perf_counter() - started)
+        else:
+            text = await process_template(output, env)
+    finally:
+        fragment_deps.reset(token)
+    if parent_deps is not None:
+        parent_deps.update(deps)
+    
+    if key is None:
+        # The page may have declared itself cacheable during this render.
+        key, policy = fragment_key(file_path, context)
+    if key is not None:
+        headers = dict(context["headers"]) if "headers" in context else None
+        fragment_cache.put(key, text, policy["ttl"], frozenset(deps), headers)
+    return text
+
+###########################################
+# Process Pool Rendering
+###########################################
+
+# Pages whose last render on the event loop was CPU-heavy.
+slow_pages = set()
+process_pool = None
+resource_server = None
+resource_address = None
+
+async def runs_in_process(file_path) -> bool:
+    if not PROCESS_WORKERS:
+        return False
+    if file_path in slow_pages:
+        return True
+    await load_page(file_path)
+    return "process" in page_cache.entries[file_path][2]
+
+async def render_dynamic(file_path, context) -> str:
+    """
+    Render a top-level page on the event loop or, for CPU-heavy pages, in
+    the process pool.
+    """
+    if await runs_in_process(file_path):
+        body, headers = await render_in_process(file_path, context)
+        context["headers"].update(headers)
+        return body.decode("utf-8")
+    if not (PROCESS_WORKERS and PROCESS_PROMOTE_SLOW):
+        return await render_fragment(file_path, context)
+    timed = CPUTimed(render_fragment(file_path, context))
+    text = await timed
+    if timed.cpu > PROCESS_RENDER_THRESHOLD:
+        slow_pages.add(file_path)
+    return text
+
+class CPUTimed:
+    """
+    Await a coroutine while adding up the CPU time of its own steps in cpu,
+    leaving out whatever other tasks ran while it was suspended. Work in
+    tasks it starts (e.g. concurrent markers) is not counted.
+    """
+    def __init__(self, coro):
+        self.coro = coro
+        self.cpu = 0.0
+
+    def __await__(self):
+        value = None
+        error = None
+        while True:
+            started = time.thread_time()
+            try:
+                if error is None:
+                    yielded = self.coro.send(value)
+                else:
+                    yielded = self.coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.cpu += time.thread_time() - started
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as e:
+                value = None
+                error = e
+
+async def render_in_process(file_path, context):
+    global process_pool
+    if process_pool is None:
+        await start_resource_server()
+        process_pool = ProcessPoolExecutor(
+            max_workers=PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        process_pool,
+        render_in_worker,
+        file_path,
+        BASE_DIR,
+        dict(context["config"]),
+        tuple(context["routes"]),
+        dict(context["headers"]),
+        resource_address,
+    )
+
+def render_in_worker(file_path, base_dir, config, routes, headers, address):
+    """
+    Runs in a pool process, which keeps its own compiled page and template
+    caches between calls. Returns the rendered page as bytes plus the
+    response headers the page set.
+    """
+    global BASE_DIR
+    BASE_DIR = base_dir
+    return asyncio.run(render_worker_page(file_path, config, routes, headers, address))
+
+async def render_worker_page(file_path, config, routes, headers, address):
+    # Included files are not watched here, so do not reuse fragments between calls.
+    fragment_cache.clear()
+    resources = ResourceProxy(ResourceClient(address))
+    context = PageContext(
+        config=ConfigView(config), resources=resources, routes=routes, headers=headers,
+        hub=Unavailable("context['hub'] is not available to pages rendered in the process pool"),
+    )
+    try:
+        text = await render_fragment(file_path, context)
+    finally:
+        await resources.client.close()
+    return text.encode("utf-8"), context["headers"]
+
+class Unavailable:
+    """
+    Stands in for a context field a pool process cannot provide, failing
+    with a clear message instead of working on a process-local copy.
+    """
+    def __init__(self, message: str):
+        self.message = message
+
+    def __getattr__(self, name):
+        raise RuntimeError(self.message)
+
+class ResourceClient:
+    """
+    Connection from a pool process back to the main process's resources.
+    Messages are length-prefixed pickles of (path, args, kwargs) and
+    ("ok", value) or ("error", exception).
+    """
+    def __init__(self, address):
+        self.address = address
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def call(self, path, args, kwargs):
+        async with self.lock:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.address)
+            await write_message(self.writer, (path, args, kwargs))
+            status, value = await read_message(self.reader)
+        if status == "error":
+            raise value
+        return value
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class ResourceProxy:
+    """
+    Stands in for Resources inside a pool process: attribute access builds a
+    path (e.g. db.query) and calling it awaits the real method in the main
+    process, so await context["resources"].get_public_ip() still works.
+    """
+    def __init__(self, client, path=()):
+        self.client = client
+        self.path = path
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return ResourceProxy(self.client, self.path + (name,))
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    async def __call__(self, *args, **kwargs):
+        return await self.client.call(self.path, args, kwargs)
+
+async def write_message(writer, message):
+    data = pickle.dumps(message)
+    writer.write(struct.pack("!I", len(data)) + data)
+    await writer.drain()
+
+async def read_message(reader):
+    size, = struct.unpack("!I", await reader.readexactly(4))
+    return pickle.loads(await reader.readexactly(size))
+
+async def serve_resource_calls(reader, writer):
+    resources = Resources()
+    try:
+        while True:
+            try:
+                path, args, kwargs = await read_message(reader)
+            except asyncio.IncompleteReadError:
+                return
+            try:
+                target = resources
+                for name in path:
+                    if name.startswith("_"):
+                        raise AttributeError(name)
+                    target = getattr(target, name)
+                result = target(*args, **kwargs)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                reply = ("ok", result)
+            except Exception as e:
+                reply = ("error", e)
+            try:
+                await write_message(writer, reply)
+            except pickle.PicklingError as e:
+                await write_message(writer, ("error", RuntimeError(f"result is not picklable: {e}")))
+    finally:
+        writer.close()
+
+async def start_resource_server():
+    global resource_server, resource_address
+    if resource_server is None:
+        resource_address = os.path.join(tempfile.mkdtemp(prefix="pages-"), "resources.sock")
+        resource_server = await asyncio.start_unix_server(serve_resource_calls, resource_address)
+
+async def stop_process_pool(app):
+    global process_pool, resource_server
+    if process_pool is not None:
+        process_pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = None
+    if resource_server is not None:
+        resource_server.close()
+        resource_server = None
+        os.remove(resource_address)
+        os.rmdir(os.path.dirname(resource_address))
+
+###########################################
+# Metrics
+###########################################
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets, in seconds.
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """
+    Histograms and counters keyed by (metric name, label values). The
+    label names of each metric are given once, in HELP.
+    """
+    HELP = {
+        "pages_request_seconds": (("route",), "histogram", "Time to handle a request, by route."),
+        "pages_response_bytes_total": (("route",), "counter", "Response body bytes, by route."),
+        "pages_errors_total": (("route",), "counter", "Responses with a 5xx status, by route."),
+        "pages_route_lookup_seconds": ((), "histogram", "Time to look up dynamic pages in the route index."),
+        "pages_render_seconds": (("page",), "histogram", "Time to run a page script."),
+        "pages_template_seconds": (("page",), "histogram", "Time to process a page's template markers."),
+        "pages_include_seconds": (("page",), "histogram", "Time to render an included page."),
+        "pages_marker_seconds": (("page", "marker"), "histogram", "Time to resolve one template marker."),
+        "pages_marker_errors_total": (("page", "marker"), "counter", "Template markers that rendered an error."),
+        "pages_fs_wait_seconds": ((), "histogram", "Time file system calls waited for a thread."),
+        "pages_loop_blocked_total": (("page",), "counter", "Times the event loop was blocked past BLOCK_THRESHOLD."),
+    }
+    MARKER_LABEL_LENGTH = 60
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, labels, seconds: float):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, labels, amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def page_label(self, file_path) -> str:
+        return os.path.relpath(file_path, BASE_DIR) if file_path else ""
+
+    def marker_labels(self, segment, env) -> tuple:
+        return (
+            self.page_label(env.get("__file__")),
+            segment[1][:self.MARKER_LABEL_LENGTH],
+        )
+
+    def render(self) -> str:
+        lines = []
+        by_name = {}
+        for (name, labels), value in self.histograms.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in self.counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, (label_names, kind, text) in self.HELP.items():
+            series = by_name.get(name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(label_names, labels)]
+                if kind == "counter":
+                    lines.append(f"{name}{format_labels(pairs)} {value}")
+                    continue
+                total = 0
+                for bound, count in zip(Histogram.BUCKETS + ("+Inf",), value.counts):
+                    total += count
+                    bucket = pairs + [f'le="{bound}"']
+                    lines.append(f"{name}_bucket{format_labels(bucket)} {total}")
+                lines.append(f"{name}_sum{format_labels(pairs)} {value.sum}")
+                lines.append(f"{name}_count{format_labels(pairs)} {total}")
+        lines.extend(cache_metric_lines())
+        lines.append("# HELP pages_in_flight Requests being handled.")
+        lines.append("# TYPE pages_in_flight gauge")
+        lines.append(f"pages_in_flight {in_flight}")
+        lines.append("# HELP pages_fs_queued File system calls waiting for a thread.")
+        lines.append("# TYPE pages_fs_queued gauge")
+        lines.append(f"pages_fs_queued {fs.queued}")
+        lines.append("# HELP pages_fs_running File system calls running in a thread.")
+        lines.append("# TYPE pages_fs_running gauge")
+        lines.append(f"pages_fs_running {fs.running}")
+        lines.append("# HELP pages_fs_calls_total File system calls completed.")
+        lines.append("# TYPE pages_fs_calls_total counter")
+        lines.append(f"pages_fs_calls_total {fs.calls}")
+        lines.append("# HELP pages_loop_lag_seconds Measured event loop lag.")
+        lines.append("# TYPE pages_loop_lag_seconds gauge")
+        lines.append(f"pages_loop_lag_seconds {loop_lag.lag}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(pairs) -> str:
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def named_caches() -> dict:
+    return {
+        "page": page_cache,
+        "page_env": page_env_cache,
+        "resource": resource_cache,
+        "template": template_cache,
+        "marker": marker_cache,
+        "fragment": fragment_cache.entries,
+        "static": static_cache,
+        "compressed": compressed_cache,
+        "listing_entries": listing_entries_cache,
+        "listing": listing_cache,
+    }
+
+def cache_metric_lines() -> list:
+    stats = {name: cache.stats() for name, cache in named_caches().items()}
+    lines = []
+    for field, kind, text in (
+        ("hits", "counter", "Cache lookups that found an entry."),
+        ("misses", "counter", "Cache lookups that found nothing."),
+        ("evictions", "counter", "Entries evicted to stay within the cache limits."),
+        ("entries", "gauge", "Entries in the cache."),
+        ("bytes", "gauge", "Bytes held by size-bounded caches."),
+    ):
+        name = f"pages_cache_{field}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache, values in stats.items():
+            lines.append(f'{name}{{cache="{cache}"}} {values[field]}')
+    lines.append("# HELP pages_cache_hit_ratio Hits divided by lookups since startup.")
+    lines.append("# TYPE pages_cache_hit_ratio gauge")
+    for cache, values in stats.items():
+        lookups = values["hits"] + values["misses"]
+        ratio = values["hits"] / lookups if lookups else 0.0
+        lines.append(f'pages_cache_hit_ratio{{cache="{cache}"}} {ratio:.4f}')
+    return lines
+
+def static_route_label(ext: str) -> str:
+    # One label per known file type rather than per file, so that a large
+    # static tree does not create a series for every file.
+    return f"static:{ext}" if ext in mimetypes.types_map else "static"
+
+def metrics_route(request) -> str:
+    """
+    The route label of a request: the page file or listed directory
+    relative to BASE_DIR, "static:<ext>" for static files, or the matched
+    route pattern for anything else.
+    """
+    route = request.get("route")
+    if route is None:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "other"
+    return route
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    started = time.perf_counter()
+    try:
+        response = await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception:
+        metrics.count("pages_errors_total", (metrics_route(request),))
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("pages_request_seconds", (metrics_route(request),), elapsed)
+    route = metrics_route(request)
+    if response.status >= 500:
+        metrics.count("pages_errors_total", (route,))
+    if response.prepared:
+        # Streamed responses are fully written by the handler.
+        metrics.count("pages_response_bytes_total", (route,), response.body_length)
+    else:
+        request["metrics_counted"] = False
+    return response
+
+async def count_response_bytes(request, response):
+    # Called just before the headers are sent; file responses only know
+    # their length at this point.
+    if request.get("metrics_counted") is False and response.content_length:
+        metrics.count("pages_response_bytes_total", (metrics_route(request),), response.content_length)
+        request["metrics_counted"] = True
+
+async def metrics_handler(request):
+    return web.Response(
+        text=metrics.render(),
+        content_type="text/plain",
+        headers={"Cache-Control": "no-store"},
+    )
+
+###########################################
+# Page Profiler
+###########################################
+
+# Marker timings of the render being profiled: (kind, page, marker, seconds).
+profile_trace = contextvars.ContextVar("profile_trace", default=None)
+
+class StackSampler:
+    """
+    Samples the stack of one thread from a background thread and counts
+    identical stacks, in collapsed form (see collapse_stack).
+    """
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="page-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+
+def collapse_stack(frame) -> str:
+    """
+    Describe a stack as "outer;...;inner", starting at the first frame of
+    this module. Page frames are shown as "path/to/page_x.py:line" so the
+    report points at page source lines; asyncio internals are left out.
+    A stack without frames of this module is the loop waiting for I/O.
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    server_file = handle_request.__code__.co_filename
+    asyncio_dir = os.path.dirname(asyncio.__file__)
+    names = []
+    for frame in frames:
+        filename = frame.f_code.co_filename
+        if not names and filename != server_file:
+            continue
+        if filename.startswith(asyncio_dir):
+            continue
+        if filename.startswith(BASE_DIR + os.sep) and filename != server_file:
+            names.append(f"{os.path.relpath(filename, BASE_DIR)}:{frame.f_lineno}")
+        elif filename == "<template>":
+            names.append(f"<template>:{frame.f_lineno}")
+        else:
+            names.append(f"{os.path.basename(filename)}:{frame.f_code.co_name}")
+    return ";".join(names) if names else "(idle)"
+
+PROXY_HEADERS = ("Forwarded", "X-Forwarded-For", "X-Real-IP")
+
+def is_admin_request(request) -> bool:
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+    # A local reverse proxy would make every client look local.
+    if any(header in request.headers for header in PROXY_HEADERS):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote).is_loopback
+    except (TypeError, ValueError):
+        return False
+
+# Profiles running at once, and the switch interval to restore after the
+# last one ends. Only touched from the event loop thread.
+profiles_running = 0
+saved_switch_interval = None
+
+def lower_switch_interval():
+    global profiles_running, saved_switch_interval
+    if profiles_running == 0:
+        saved_switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(saved_switch_interval, PROFILE_INTERVAL / 2))
+    profiles_running += 1
+
+def restore_switch_interval():
+    global profiles_running
+    profiles_running -= 1
+    if profiles_running == 0:
+        sys.setswitchinterval(saved_switch_interval)
+
+async def profile_page(request, file_path, context):
+    """
+    Render a page on the event loop under the stack sampler and report
+    where the time went. "?__profile=collapsed" returns only the collapsed
+    stacks (the input format of flamegraph.pl and speedscope); otherwise
+    the stacks follow a summary of the render and of each marker and
+    include. Other requests served meanwhile show up in the samples too.
+    """
+    trace = []
+    token = profile_trace.set(trace)
+    sampler = StackSampler(threading.get_ident())
+    # The sampler needs the GIL to take a sample; a busy page only hands it
+    # over every switch interval (5 ms by default).
+    lower_switch_interval()
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        # Bypass the fragment cache and process pool for the page itself.
+        output, env = await render_page(file_path, context)
+        await process_template(output, env)
+    finally:
+        sampler.stop()
+        restore_switch_interval()
+        profile_trace.reset(token)
+    elapsed = time.perf_counter() - started
+    stacks = [f"{stack} {count}" for stack, count in sampler.samples.most_common()]
+    if request.query.get("__profile") == "collapsed":
+        return web.Response(text="\n".join(stacks) + "\n", headers={"Cache-Control": "no-store"})
+    lines = [
+        f"# page: {os.path.relpath(file_path, BASE_DIR)}",
+        f"# wall time: {elapsed * 1000:.2f} ms, {sum(sampler.samples.values())} samples"
+        f" every {PROFILE_INTERVAL * 1000:g} ms",
+        "# markers and includes (ms, kind, page, marker):",
+    ]
+    for kind, page, marker, seconds in sorted(trace, key=lambda item: -item[3]):
+        lines.append(f"#   {seconds * 1000:9.2f}  {kind:7}  {page}  {marker}")
+    lines.append("# collapsed stacks:")
+    lines.extend(stacks)
+    return web.Response(text="\n".join(lines) + "\n", headers={"Cache-Control": "no-store"})
+
+###########################################
+# Admission Control
+###########################################
+
+class LoopLagMonitor:
+    """
+    Measures event-loop lag: how late a periodic sleep wakes up. A loop
+    busy with a blocking page shows up as lag for every other request.
+    """
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self.task = None
+        # time.monotonic() of the last wakeup, read by the watchdog thread.
+        self.beat = None
+
+    async def start(self, app):
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self, app):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.lag = 0.0
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.beat = time.monotonic()
+            lag = loop.time() - started - self.interval
+            # Rise at once, recover gradually.
+            self.lag = max(lag, self.lag * 0.5)
+
+loop_lag = LoopLagMonitor()
+
+class BlockingWatchdog:
     """
-    Do not allow serving any file or folder whose name starts with a dot or underscore.
+    Watches the lag monitor's heartbeat from a separate thread. When the
+    loop misses it by more than BLOCK_THRESHOLD, the loop thread's stack
+    is captured once per stall and attributed to the innermost page frame,
+    which is the page file and line doing the blocking work.
     """
-    parts = rel_path.split(os.sep)
-    for part in parts:
-        if part.startswith(".") or part.startswith("_"):
-            return False
-    return True
+    def __init__(self, monitor: LoopLagMonitor, threshold: float = BLOCK_THRESHOLD):
+        self.monitor = monitor
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread = None
+        self.thread = None
+        self.stopped = threading.Event()
+        # Dicts of page, line, stack, started, duration; newest last.
+        self.reports = deque(maxlen=BLOCK_REPORTS)
+        # Page (or function) -> number of stalls it caused.
+        self.offenders = Counter()
+
+    async def start(self, app):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="pages-watchdog", daemon=True)
+        self.thread.start()
 
-def is_folder_public(file_path: str) -> bool:
+    async def stop(self, app):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        report = None
+        poll = min(self.threshold / 4, 0.05)
+        while not self.stopped.wait(poll):
+            beat = self.monitor.beat
+            if beat is None:
+                continue
+            stalled = time.monotonic() - beat - self.monitor.interval
+            if stalled > self.threshold:
+                if report is None:
+                    report = self._capture(beat)
+                if report is not None:
+                    report["duration"] = stalled
+            elif report is not None:
+                self._finish(report)
+                report = None
+
+    def _capture(self, beat: float):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return None
+        page, line = blocking_site(frame)
+        report = {
+            "page": page,
+            "line": line,
+            "stack": "".join(traceback.format_stack(frame)[-12:]),
+            "started": time.time() - (time.monotonic() - beat),
+            "duration": 0.0,
+        }
+        return report
+
+    def _finish(self, report: dict):
+        print(
+            f"WARNING: event loop blocked for {report['duration']:.3f}s at "
+            f"{report['page']}:{report['line']}\n{report['stack']}",
+            file=sys.stderr,
+        )
+        # The loop thread reads the reports and metrics, so they are only
+        # updated there.
+        try:
+            self.loop.call_soon_threadsafe(self._record, report)
+        except RuntimeError:
+            # The loop has closed.
+            pass
+
+    def _record(self, report: dict):
+        self.reports.append(report)
+        self.offenders[report["page"]] += 1
+        if METRICS_ENABLED:
+            metrics.count("pages_loop_blocked_total", (str(report["page"]),))
+        file_path = os.path.join(BASE_DIR, report["page"])
+        # Includes always render in their parent, so only pages are moved.
+        if BLOCK_QUARANTINE and PROCESS_WORKERS and is_page_file(os.path.basename(file_path)):
+            quarantine_page(file_path)
+
+def blocking_site(frame) -> tuple:
     """
-    Walk up from the file’s folder. If any folder contains a marker file (".private"),
-    then the file should not be served.
+    Return (page, line) for the innermost frame of a page file, relative to
+    BASE_DIR, or for the innermost frame at all if no page is involved.
     """
-    current = os.path.dirname(file_path)
-    while current.startswith(BASE_DIR):
-        if os.path.exists(os.path.join(current, ".private")):
-            return False
-        if current == BASE_DIR:
-            break
-        current = os.path.dirname(current)
+    server_file = handle_request.__code__.co_filename
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(BASE_DIR + os.sep) and filename != server_file:
+            return os.path.relpath(filename, BASE_DIR), frame.f_lineno
+        if filename == "<template>":
+            return "<template>", frame.f_lineno
+        frame = frame.f_back
+    code = innermost.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}", innermost.f_lineno
+
+def quarantine_page(file_path: str):
+    if file_path not in slow_pages:
+        print(f"WARNING: rendering {file_path} in the process pool from now on", file=sys.stderr)
+        slow_pages.add(file_path)
+
+watchdog = BlockingWatchdog(loop_lag)
+# Page path -> semaphore limiting concurrent renders of that page.
+route_slots = {}
+in_flight = 0
+
+async def acquire_route_slot(file_path) -> bool:
+    slots = route_slots.get(file_path)
+    if slots is None:
+        slots = route_slots[file_path] = asyncio.Semaphore(ROUTE_CONCURRENCY)
+    try:
+        async with asyncio.timeout(ROUTE_QUEUE_TIMEOUT):
+            await slots.acquire()
+    except TimeoutError:
+        return False
     return True
 
-def can_serve_file(file_path: str) -> bool:
-    rel = os.path.relpath(file_path, BASE_DIR)
-    return is_path_allowed(rel) and is_folder_public(file_path)
+def release_route_slot(file_path):
+    route_slots[file_path].release()
 
-def resolve_file_path(url_path: str) -> str:
+def overloaded_response():
+    return web.Response(
+        status=503,
+        text="Server is busy, please retry.",
+        headers={"Retry-After": str(RETRY_AFTER)},
+    )
+
+def is_exempt_from_shedding(path: str) -> bool:
+    return path == "/metrics" or path == "/admin" or path.startswith("/admin/")
+
+@web.middleware
+async def admission_middleware(request, handler):
     """
-    Converts a URL path (e.g. "/folder/file.json") to an absolute file system path.
-    Returns None if the path is not within BASE_DIR.
+    Shed load with a fast 503 when too many requests are in flight or the
+    event loop is lagging, so the requests already accepted finish in time.
     """
-    # Remove any query string.
-    url_path = url_path.split("?", 1)[0]
-    if url_path.startswith("/"):
-        url_path = url_path[1:]
-    full_path = os.path.abspath(os.path.join(BASE_DIR, url_path))
-    if not full_path.startswith(BASE_DIR):
+    global in_flight
+    if not is_exempt_from_shedding(request.path) and (
+        in_flight >= MAX_IN_FLIGHT or loop_lag.lag > MAX_LOOP_LAG
+    ):
+        return overloaded_response()
+    if request.path.startswith("/hub/"):
+        # Hub connections stay open; they are not requests in flight.
+        return await handler(request)
+    in_flight += 1
+    try:
+        return await handler(request)
+    finally:
+        in_flight -= 1
+
+###########################################
+# Conditional Requests
+###########################################
+
+def body_etag(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+async def page_version_etag(file_path, context):
+    """
+    Return the ETag for a page that declared version(...), or None.
+    """
+    code = page_versions.get(file_path)
+    if code is None:
         return None
-    return full_path
+    try:
+        await load_page(file_path)
+        signature = page_cache.entries[file_path][0]
+        value = eval(code, {"context": context})
+    except Exception:
+        return None
+    return hashlib.blake2b(repr((file_path, signature, value)).encode("utf-8"), digest_size=16).hexdigest()
 
-def get_index_file(directory: str) -> str:
+def etag_matches(request, etag: str) -> bool:
     """
-    In a directory, look for an index file. (This can be static or dynamic.)
-    For dynamic pages the file must start with "page_" and end with ".py".
+    Weak comparison of If-None-Match against our ETag value (unquoted),
+    also accepting the tags of its compressed variants.
     """
-    # Try dynamic index pages first.
-    for candidate in ["page_home.py", "page_index.py"]:
-        candidate_path = os.path.join(directory, candidate)
-        if os.path.exists(candidate_path) and can_serve_file(candidate_path):
-            return candidate_path
-    # Then try some common static index files.
-    for candidate in ["index.html", "index.json", "index.zip"]:
-        candidate_path = os.path.join(directory, candidate)
-        if os.path.exists(candidate_path) and can_serve_file(candidate_path):
-            return candidate_path
-    return None
+    for candidate in request.if_none_match or ():
+        value = candidate.value
+        if value == etag or value == "*":
+            return True
+        if value.startswith(etag) and value[len(etag):] in ("-gzip", "-deflate"):
+            return True
+    return False
 
-def directory_listing(directory: str, rel_dir: str) -> str:
+def not_modified(request, etag=None, last_modified=None) -> bool:
+    if request.if_none_match:
+        return etag is not None and etag_matches(request, etag)
+    since = request.if_modified_since
+    return since is not None and last_modified is not None and last_modified <= since
+
+def page_response(request, body: bytes, etag: str, headers: dict):
     """
-    Generate a simple HTML directory listing.
+    Build the response for a rendered page: 200 with validators, or 304 if
+    the client's copy is current. Last-Modified may be set by the page as a
+    string, a timestamp or a datetime.
     """
-    entries = os.listdir(directory)
-    entries = [e for e in entries if is_path_allowed(e)]
-    html = f"<html><head><title>Index of /{rel_dir}</title></head><body>"
-    html += f"<h1>Index of /{rel_dir}</h1><ul>"
-    # Link to parent directory if not at the base.
-    if rel_dir and rel_dir != ".":
-        parent = os.path.dirname(rel_dir)
-        html += f'<li><a href="/{parent}">../</a></li>'
-    for entry in entries:
-        full_entry = os.path.join(directory, entry)
-        rel_entry = os.path.join(rel_dir, entry) if rel_dir != "." else entry
-        if os.path.isdir(full_entry):
-            html += f'<li>[DIR] <a href="/{rel_entry}">{entry}/</a></li>'
-        else:
-            html += f'<li>[FILE] <a href="/{rel_entry}">{entry}</a></li>'
-    html += "</ul></body></html>"
-    return html
+    headers = dict(headers)
+    last_modified = headers.pop("Last-Modified", None)
+    response = web.Response(body=body, content_type="text/html", charset="utf-8", headers=headers)
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if not_modified(request, etag, response.last_modified):
+        return web.Response(status=304, headers=response.headers)
+    return response
 
 ###########################################
-# Dynamic Page Helpers
+# Static Files
 ###########################################
 
-def list_dynamic_pages() -> dict:
-    pages = {}
-    for root, dirs, files in os.walk(BASE_DIR):
-        for file in files:
-            if file.endswith(".py") and file.startswith("page_"):
-                full_path = os.path.join(root, file)
-                if can_serve_file(full_path):
-                    # Get the relative directory of the file (if any)
-                    rel_dir = os.path.relpath(root, BASE_DIR)
-                    # Remove "page_" prefix and ".py" suffix from the file name.
-                    base_name = file[len("page_"):-3]
-                    # Combine folder path and base name if not in the base folder.
-                    if rel_dir != ".":
-                        page_name = f"{rel_dir}/{base_name}"
-                    else:
-                        page_name = base_name
-                    pages[page_name] = os.path.relpath(full_path, BASE_DIR)
-    return pages
-
-def find_dynamic_page(page_name: str) -> str:
+def read_static_file(file_path: str, st) -> tuple:
     """
-    Look up a dynamic page by its name. For example, for page_name="about"
-    this looks for a file named "page_about.py" anywhere under BASE_DIR.
-    Returns the absolute path if found; otherwise, None.
+    Read a small static file and its .gz sibling (if one exists and is not
+    older than the file). Runs in a worker thread.
     """
-    pages = list_dynamic_pages()
-    if page_name in pages:
-        return os.path.join(BASE_DIR, pages[page_name])
-    return None
+    with open(file_path, "rb") as f:
+        body = f.read()
+    gz_body = None
+    gz_stat = stat_path(file_path + ".gz")
+    if gz_stat is not None and gz_stat.st_mtime_ns >= st.st_mtime_ns:
+        with open(file_path + ".gz", "rb") as f:
+            gz_body = f.read()
+    return body, gz_body
 
-###########################################
-# Resources for Dynamic Pages
-###########################################
+# Small static files as ready-to-send bytes, keyed by absolute path.
+# Each entry: (file signature, body, gzip body or None)
+static_cache = LRUCache(
+    max_entries=4096,
+    max_bytes=STATIC_CACHE_BYTES,
+    sizeof=lambda entry: len(entry[1]) + len(entry[2] or b""),
+)
 
-class Resources:
-    async def get_public_ip(self):
-        # In a real server you might query an external service.
-        return "127.0.0.1"
+def static_content_type(file_path: str):
+    if file_path.lower().endswith(".json"):
+        return "application/json", "utf-8"
+    content_type, _ = mimetypes.guess_type(file_path)
+    return content_type or "application/octet-stream", None
+
+async def serve_static(request, file_path, headers=None, st=None):
+    """
+    Serve a static file with ETag, Last-Modified and Range support.
+
+    Small files come from an in-memory cache (with the gzip variant when a
+    .gz sibling exists and the client accepts it). Large files go through
+    FileResponse, which uses sendfile and applies the same validators.
+    `st` is the file's stat if the caller already has it.
+    """
+    if st is None:
+        st = await fs.run(os.stat, file_path)
+    if st.st_size > STATIC_CACHE_MAX_FILE:
+        return web.FileResponse(file_path, headers=headers)
     
-    async def list_routes(self):
-        # Return the dynamic page names.
-        return list(list_dynamic_pages().keys())
+    signature = file_signature(st)
+    entry = static_cache.get(file_path)
+    if entry is None or entry[0] != signature:
+        body, gz_body = await fs.run(read_static_file, file_path, st)
+        entry = (signature, body, gz_body)
+        static_cache.put(file_path, entry)
+    body, gz_body = entry[1], entry[2]
+    
+    # Same validator format as FileResponse, so it does not change when a
+    # file crosses the cache size limit. The gzip variant gets its own tag.
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    response = web.Response(headers=headers)
+    response.content_type, charset = static_content_type(file_path)
+    if charset:
+        response.charset = charset
+    response.last_modified = st.st_mtime
+    rng = None
+    if "Range" in request.headers and if_range_matches(request, etag, response.last_modified):
+        try:
+            rng = request.http_range
+        except ValueError:
+            # Malformed, or several ranges: send the whole file instead.
+            pass
+    use_gzip = (
+        gz_body is not None
+        and rng is None
+        and negotiate_encoding(request.headers.get("Accept-Encoding", "")) == "gzip"
+    )
+    if use_gzip:
+        etag += "-gzip"
+    response.etag = etag
+    response.headers["Accept-Ranges"] = "bytes"
+    if gz_body is not None:
+        response.headers["Vary"] = "Accept-Encoding"
+    
+    if not_modified(request, etag, response.last_modified):
+        return web.Response(status=304, headers=response.headers)
+    
+    if rng is not None:
+        start, stop, _ = rng.indices(len(body))
+        if start >= stop:
+            response.headers["Content-Range"] = f"bytes */{len(body)}"
+            return web.Response(status=416, headers=response.headers)
+        response.set_status(206)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(body)}"
+        response.body = body[start:stop]
+        return response
+    
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+        response.body = gz_body
+    else:
+        response.body = body
+    return response
+
+def if_range_matches(request, etag, last_modified) -> bool:
+    """
+    A Range request applies unless If-Range names a different version.
+    """
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == f'"{etag}"'
+    return request.if_range is not None and last_modified <= request.if_range
+
+def precompress_static_files(base_dir: str) -> int:
+    """
+    Write (or refresh) a .gz sibling for every compressible static file in
+    the servable part of the tree. Runs in a worker thread at startup.
+    """
+    written = 0
+    for root, dirs, files in os.walk(base_dir):
+        dirs[:] = [d for d in dirs if is_path_allowed(d)]
+        for file in files:
+            if os.path.splitext(file)[1].lower() not in STATIC_COMPRESSIBLE:
+                continue
+            full_path = os.path.join(root, file)
+            st = stat_path(full_path)
+            if st is None or st.st_size < 256:
+                continue
+            gz_stat = stat_path(full_path + ".gz")
+            if gz_stat is not None and gz_stat.st_mtime_ns >= st.st_mtime_ns:
+                continue
+            with open(full_path, "rb") as f:
+                data = gzip.compress(f.read(), compresslevel=9, mtime=0)
+            tmp_path = os.path.join(root, f".{file}.gz.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, full_path + ".gz")
+            written += 1
+    return written
+
+async def precompress_on_startup(app):
+    await fs.run(precompress_static_files, BASE_DIR)
 
 ###########################################
-# Templating Engine for Dynamic Pages
+# Directory Listings
 ###########################################
 
-import os
-# Make sure BASE_DIR is defined globally (it is in our full server code)
-# from earlier: BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# Sorted directory entries keyed by (directory, sort). Each value is
+# (directory mtime_ns, [(name, is_dir), ...]).
+listing_entries_cache = LRUCache(256)
+# Rendered listing pages keyed by (directory, sort, order, offset, limit).
+# Each value is (directory mtime_ns, body bytes, etag).
+listing_cache = LRUCache(1024, LISTING_CACHE_BYTES, sizeof=lambda entry: len(entry[1]))
 
-import os
+def scan_directory(directory: str, sort: str) -> list:
+    """
+    List the servable entries of a directory with os.scandir, using the
+    entry type it already knows instead of a stat per entry. Sorting by size
+    or mtime stats each entry once. Runs in a worker thread.
+    """
+    entries = []
+    keys = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not is_path_allowed(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            entries.append((entry.name, is_dir))
+            if sort != "name":
+                try:
+                    st = entry.stat()
+                    keys[entry.name] = st.st_size if sort == "size" else st.st_mtime_ns
+                except OSError:
+                    keys[entry.name] = 0
+    if sort == "name":
+        entries.sort()
+    else:
+        entries.sort(key=lambda e: (keys[e[0]], e[0]))
+    return entries
 
-# Ensure BASE_DIR is defined globally.
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+async def directory_entries(directory: str, mtime_ns: int, sort: str) -> list:
+    cached = listing_entries_cache.get((directory, sort))
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    entries = await fs.run(scan_directory, directory, sort)
+    listing_entries_cache.put((directory, sort), (mtime_ns, entries))
+    return entries
 
-import os
+def listing_rows(entries, rel_dir: str):
+    for name, is_dir in entries:
+        rel_entry = html.escape(os.path.join(rel_dir, name) if rel_dir != "." else name)
+        name = html.escape(name)
+        if is_dir:
+            yield f'<li>[DIR] <a href="/{rel_entry}">{name}/</a></li>'
+        else:
+            yield f'<li>[FILE] <a href="/{rel_entry}">{name}</a></li>'
 
-# Assume BASE_DIR is defined as the server script's directory.
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+def query_int(request, name: str, default: int, low: int, high: int) -> int:
+    try:
+        value = int(request.query.get(name, default))
+    except ValueError:
+        return default
+    return min(max(value, low), high)
 
-async def process_template(template_str, env):
+async def directory_listing(request, directory: str, rel_dir: str, st=None):
     """
-    Processes template markers of the form {{ ... }}.
+    Generate an HTML directory listing page.
+
+    The rendered page is cached until the directory's mtime changes; large
+    pages are streamed to the client in batches of rows while rendering.
+    """
+    sort = request.query.get("sort", "name")
+    if sort not in ("name", "size", "mtime"):
+        sort = "name"
+    order = "desc" if request.query.get("order") == "desc" else "asc"
+    offset = query_int(request, "offset", 0, 0, 2 ** 31)
+    limit = query_int(request, "limit", LISTING_PAGE_SIZE, 1, LISTING_MAX_LIMIT)
     
-    Special handling:
-      - Markers starting with ".\\" are treated as file references relative to BASE_DIR.
-      - Markers starting with "./" are treated as file references relative to the current page's directory.
-      - Markers starting with "..\\" or "../" allow upward traversal (relative to BASE_DIR or the current page dir).
-      - Markers that simply end with ".py" (for example, "page_home_footer.py")
-        are treated as file references relative to the current page's directory.
-      - Otherwise, the marker is evaluated as a Python expression (with a fallback to include a file if a bare identifier is missing).
-    """
-    import re
-    pattern = re.compile(r"\{\{\s*(.*?)\s*\}\}", re.DOTALL)
-    
-    async def repl(match):
-        code = match.group(1).strip()
-        candidate = None  # Candidate file's absolute path
-        relative_path = None  # The provided file reference (if any)
-    
-        # -- Special file-reference markers with explicit prefixes --
-        if code.startswith(".\\"):
-            # Example: ".\pages\page_home_footer"
-            relative_path = code[2:]
-            base = BASE_DIR
-            candidate = os.path.abspath(os.path.join(base, relative_path))
-        elif code.startswith("./"):
-            # Example: "./page_home_footer"
-            relative_path = code[2:]
-            base = env.get("__page_dir__", BASE_DIR)
-            candidate = os.path.abspath(os.path.join(base, relative_path))
-        elif code.startswith("..\\"):
-            # Example: "..\subfolder\somefile"
-            relative_path = code  # Keep the "..\\" in the path.
-            base = BASE_DIR
-            candidate = os.path.abspath(os.path.join(base, relative_path))
-        elif code.startswith("../"):
-            # Example: "../subfolder/somefile"
-            relative_path = code  # Keep the "../" in the path.
-            base = env.get("__page_dir__", BASE_DIR)
-            candidate = os.path.abspath(os.path.join(base, relative_path))
-        # -- New branch: if the marker ends with ".py", treat it as a file include --
-        elif code.endswith(".py"):
-            # For example: "page_home_footer.py"
-            relative_path = code  # Use the marker text as the relative file name.
-            base = env.get("__page_dir__", BASE_DIR)
-            candidate = os.path.abspath(os.path.join(base, relative_path))
-    
-        # If a candidate file was determined via any of the above file-reference rules,
-        # attempt to include and render that file.
-        if candidate is not None:
-            # Security check: Ensure candidate is within BASE_DIR.
-            if candidate.startswith(BASE_DIR) and os.path.exists(candidate):
-                try:
-                    # Assume render_page() takes (file_path, context) and returns (output, env)
-                    sub_output, sub_env = await render_page(candidate, env["context"])
-                    # Recursively process any template markers in the included file.
-                    return await process_template(sub_output, sub_env)
-                except Exception as e:
-                    return f"[Error including file '{relative_path}': {e}]"
-            else:
-                return f"[Error: File '{relative_path}' not found or access denied]"
+    if st is None:
+        st = await fs.run(os.stat, directory)
+    mtime_ns = st.st_mtime_ns
+    key = (directory, sort, order, offset, limit)
+    cached = listing_cache.get(key)
+    if cached is None or cached[0] != mtime_ns:
+        cached = None
+    etag = cached[2] if cached else body_etag(repr((key, mtime_ns)).encode("utf-8"))
+    if request.if_none_match and etag_matches(request, etag):
+        return web.Response(status=304, headers={"ETag": f'"{etag}"'})
+    if cached is not None:
+        response = web.Response(body=cached[1], content_type="text/html", charset="utf-8")
+        response.etag = etag
+        return response
     
-        # -- Otherwise, treat the marker as a Python expression --
-        try:
-            if code.startswith("await "):
-                expr = code[6:].strip()
-                result = await eval(expr, env)
-            else:
-                result = eval(code, env)
-        except NameError as ne:
-            # Fallback: if the marker is a bare identifier, try to include a file with that name.
-            if code.isidentifier():
-                page_dir = env.get("__page_dir__", BASE_DIR)
-                candidate = os.path.join(page_dir, f"{code}.py")
-                if os.path.exists(candidate):
-                    sub_output, sub_env = await render_page(candidate, env["context"])
-                    result = await process_template(sub_output, sub_env)
-                else:
-                    result = f"[Error: {ne}]"
-            else:
-                result = f"[Error: {ne}]"
-        except Exception as e:
-            result = f"[Error: {e}]"
+    entries = await directory_entries(directory, mtime_ns, sort)
+    if order == "desc":
+        entries = entries[::-1]
+    page = entries[offset:offset + limit]
     
-        return str(result)
+    title = html.escape(rel_dir)
+    head = [f"<html><head><title>Index of /{title}</title></head><body>",
+            f"<h1>Index of /{title}</h1><ul>"]
+    # Link to parent directory if not at the base.
+    if rel_dir and rel_dir != ".":
+        parent = html.escape(os.path.dirname(rel_dir))
+        head.append(f'<li><a href="/{parent}">../</a></li>')
+    tail = ["</ul>"]
+    base = f"/{title}" if rel_dir != "." else "/"
+    if offset > 0:
+        prev_offset = max(offset - limit, 0)
+        tail.append(f'<a href="{base}?offset={prev_offset}&amp;limit={limit}&amp;sort={sort}&amp;order={order}">Previous</a> ')
+    if offset + limit < len(entries):
+        tail.append(f'<a href="{base}?offset={offset + limit}&amp;limit={limit}&amp;sort={sort}&amp;order={order}">Next</a>')
+    tail.append("</body></html>")
     
-    parts = []
-    last = 0
-    for m in pattern.finditer(template_str):
-        parts.append(template_str[last:m.start()])
-        parts.append(await repl(m))
-        last = m.end()
-    parts.append(template_str[last:])
-    return "".join(parts)
+    if len(page) <= LISTING_STREAM_ROWS:
+        body = "".join(head + list(listing_rows(page, rel_dir)) + tail).encode("utf-8")
+        listing_cache.put(key, (mtime_ns, body, etag))
+        response = web.Response(body=body, content_type="text/html", charset="utf-8")
+        response.etag = etag
+        return response
+    
+    response = web.StreamResponse(headers={"Content-Type": "text/html; charset=utf-8"})
+    response.etag = etag
+    response.enable_chunked_encoding()
+    if COMPRESS_RESPONSES:
+        response.enable_compression()
+    await response.prepare(request)
+    chunks = []
+    batch = head
+    for row in listing_rows(page, rel_dir):
+        batch.append(row)
+        if len(batch) >= 500:
+            chunk = "".join(batch).encode("utf-8")
+            chunks.append(chunk)
+            await response.write(chunk)
+            batch = []
+    chunk = "".join(batch + tail).encode("utf-8")
+    chunks.append(chunk)
+    await response.write(chunk)
+    await response.write_eof()
+    listing_cache.put(key, (mtime_ns, b"".join(chunks), etag))
+    return response
 
-async def render_page(file_path, context):
+###########################################
+# Response Compression
+###########################################
+
+# Compressed bodies keyed by (ETag, encoding), so responses with the same
+# validator (cached pages, static files) are compressed only once.
+compressed_cache = LRUCache(
+    max_entries=4096,
+    max_bytes=COMPRESS_CACHE_BYTES,
+    sizeof=len,
+)
+
+def negotiate_encoding(accept_encoding: str):
     """
-    Load a dynamic page (a .py file whose name starts with "page_"),
-    wrap its source in an async function (to allow await), and capture its output.
+    Pick gzip or deflate from an Accept-Encoding header, honouring q=0.
+    """
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    best = None
+    for encoding in ("gzip", "deflate"):
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > 0 and (best is None or q > accepted.get(best, accepted.get("*", 0.0))):
+            best = encoding
+    return best
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    # wbits 31 writes a gzip container, 15 a zlib one (HTTP "deflate").
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    return compressor.compress(body) + compressor.flush()
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """
+    Compress plain in-memory responses. Streamed and file responses, error
+    responses and bodies that are small, already encoded or of a
+    non-compressible type (e.g. .zip) are passed through.
     """
-    with open(file_path, "r", encoding="utf-8") as f:
-        source = f.read()
+    response = await handler(request)
+    if not COMPRESS_RESPONSES or type(response) is not web.Response or response.status != 200:
+        return response
+    body = response.body
+    if (
+        not isinstance(body, bytes)
+        or len(body) < COMPRESS_MIN_SIZE
+        or "Content-Encoding" in response.headers
+        or not is_compressible(response.content_type)
+    ):
+        return response
     
-    env = {}
-    env["context"] = context
-    output = io.StringIO()
+    response.headers["Vary"] = "Accept-Encoding"
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
     
-    def captured_print(*args, **kwargs):
-        print(*args, **kwargs, file=output)
-    env["print"] = captured_print
-    env["debug"] = print
-    # Save the directory where the page resides to support includes.
-    env["__page_dir__"] = os.path.dirname(file_path)
+    etag = response.etag
+    # Static ETags (mtime and size) can repeat across files, so the path is
+    # part of the key.
+    key = (request.path, etag.value, encoding) if etag is not None and not etag.is_weak else None
+    compressed = compressed_cache.get(key) if key is not None else None
+    if compressed is None:
+        if len(body) > COMPRESS_THREAD_SIZE:
+            loop = asyncio.get_running_loop()
+            compressed = await loop.run_in_executor(None, compress_body, body, encoding)
+        else:
+            compressed = compress_body(body, encoding)
+        if key is not None:
+            compressed_cache.put(key, compressed)
     
-    wrapped_source = "async def __template_main__():\n"
-    for line in source.splitlines():
-        wrapped_source += "    " + line + "\n"
+    response.body = compressed
+    response.headers["Content-Encoding"] = encoding
+    if key is not None:
+        # A strong tag must differ per encoding; a weak one may be shared.
+        response.etag = f"{etag.value}-{encoding}"
+    return response
+
+###########################################
+# Worker Coordination
+###########################################
+
+def apply_config(data: dict):
+    global config_snapshot
+    global_config.update(data)
+    config_snapshot = None
+    # Cached fragments may show the old configuration.
+    fragment_cache.clear()
+
+# Handlers for messages from other worker processes, keyed by operation.
+cluster_handlers = {
+    "config": apply_config,
+}
+
+class ClusterChannel:
+    """
+    A worker's connection to the supervisor in multi-process mode. Messages
+    are JSON lines {"op": ..., "data": ...}; the supervisor relays each one
+    to every other worker, where cluster_handlers[op](data) is called.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.writer = None
+        self.task = None
+
+    async def start(self, app):
+        reader, self.writer = await asyncio.open_connection(sock=self.sock)
+        self.task = asyncio.create_task(self._read(reader))
+
+    async def stop(self, app):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def send(self, op: str, data):
+        if self.writer is not None:
+            self.writer.write(json.dumps({"op": op, "data": data}).encode("utf-8") + b"\n")
+
+    async def _read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            # A bad message or a failing handler must not stop the channel,
+            # or this worker would miss every later update.
+            try:
+                message = json.loads(line)
+                handler = cluster_handlers.get(message.get("op"))
+                if handler is not None:
+                    handler(message.get("data"))
+            except Exception as e:
+                print(f"WARNING: cluster message failed: {e!r}", file=sys.stderr)
+
+# Set in worker processes started by the supervisor.
+cluster = None
+
+def broadcast(op: str, data):
+    """
+    Send a message to the other worker processes (no-op in single-process mode).
+    """
+    if cluster is not None:
+        cluster.send(op, data)
+
+###########################################
+# Pub/Sub Hub
+###########################################
+
+ROOM_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+class HubMessage:
+    """
+    A published message, serialized once for all subscribers: the JSON text
+    for WebSocket clients and the encoded event for SSE clients.
+    """
+    __slots__ = ("id", "text", "event")
+
+    def __init__(self, message_id: int, text: str):
+        self.id = message_id
+        self.text = text
+        self.event = f"id: {message_id}\ndata: {text}\n\n".encode("utf-8")
+
+class Subscriber:
+    """
+    One connected client: a bounded queue of messages waiting to be sent.
+    None in the queue means the client was dropped.
+    """
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self):
+        self.queue = asyncio.Queue(HUB_QUEUE_SIZE)
+        self.dropped = False
+
+    def offer(self, message) -> bool:
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def drop(self):
+        self.dropped = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+class Room:
+    __slots__ = ("subscribers", "history", "last_id")
+
+    def __init__(self):
+        self.subscribers = set()
+        self.history = deque(maxlen=HUB_HISTORY)
+        self.last_id = 0
+
+class PubSubHub:
+    """
+    Rooms of subscribers. publish() serializes a message once and puts it
+    on every subscriber's queue without waiting; clients whose queue is
+    full are dropped instead of slowing down the room. In multi-process
+    mode messages are relayed to the other workers, so message ids are
+    only unique within a worker.
+    """
+    def __init__(self):
+        self.rooms = {}
+
+    def room(self, name: str, create=True):
+        room = self.rooms.get(name)
+        if room is None and create:
+            if not ROOM_NAME_PATTERN.fullmatch(name):
+                raise ValueError(f"Invalid room name: {name!r}")
+            if len(self.rooms) >= HUB_MAX_ROOMS:
+                self._forget_idle_rooms()
+                if len(self.rooms) >= HUB_MAX_ROOMS:
+                    raise ValueError("Too many rooms")
+            room = self.rooms[name] = Room()
+        return room
+
+    def _forget_idle_rooms(self):
+        for name in [name for name, room in self.rooms.items() if not room.subscribers]:
+            del self.rooms[name]
+
+    def subscribe(self, name: str, since: int = 0) -> Subscriber:
+        """
+        Join a room. Messages after id `since` still in the history are
+        queued first.
+        """
+        room = self.room(name)
+        subscriber = Subscriber()
+        for message in room.history:
+            if message.id > since:
+                subscriber.offer(message)
+        room.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, name: str, subscriber: Subscriber):
+        room = self.rooms.get(name)
+        if room is not None:
+            room.subscribers.discard(subscriber)
+
+    def publish(self, name: str, data, relay=True) -> int:
+        """
+        Send data (anything JSON-serializable) to everyone in a room and
+        return the message id.
+        """
+        room = self.room(name)
+        room.last_id += 1
+        message = HubMessage(room.last_id, json.dumps({"id": room.last_id, "room": name, "data": data}))
+        room.history.append(message)
+        slow = [subscriber for subscriber in room.subscribers if not subscriber.offer(message)]
+        for subscriber in slow:
+            room.subscribers.discard(subscriber)
+            subscriber.drop()
+        if relay:
+            broadcast("hub", {"room": name, "data": data})
+        return room.last_id
+
+    def history(self, name: str) -> list:
+        room = self.rooms.get(name)
+        if room is None:
+            return []
+        return [json.loads(message.text) for message in room.history]
+
+    def subscribers(self, name: str) -> int:
+        room = self.rooms.get(name)
+        return len(room.subscribers) if room is not None else 0
+
+    def close(self):
+        for room in self.rooms.values():
+            for subscriber in room.subscribers:
+                subscriber.drop()
+            room.subscribers.clear()
+
+hub = PubSubHub()
+def apply_hub_message(data: dict):
+    try:
+        hub.publish(data["room"], data["data"], relay=False)
+    except ValueError:
+        # Room limit reached here; the message reached the other workers.
+        pass
+
+cluster_handlers["hub"] = apply_hub_message
+
+async def close_hub(app):
+    hub.close()
+
+def hub_message_data(text: str):
+    # JSON from clients is published as is; anything else as a string.
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+async def hub_websocket(request):
+    """
+    WebSocket endpoint of a room: text frames sent by the client are
+    published, published messages are sent as JSON text frames.
+    """
+    name = request.match_info["room"]
+    if not ROOM_NAME_PATTERN.fullmatch(name):
+        return web.Response(status=404, text="Room not found")
+    ws = web.WebSocketResponse(heartbeat=HUB_HEARTBEAT, max_msg_size=HUB_MAX_MESSAGE)
+    await ws.prepare(request)
+    try:
+        subscriber = hub.subscribe(name, query_int(request, "since", 0, 0, sys.maxsize))
+    except ValueError as e:
+        await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=str(e).encode("utf-8"))
+        return ws
     
-    exec(wrapped_source, env)
-    await env["__template_main__"]()
-    return output.getvalue(), env
+    async def send_messages():
+        while True:
+            message = await subscriber.queue.get()
+            if message is None:
+                # Too slow to keep up with the room.
+                await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"Too slow")
+                return
+            await ws.send_str(message.text)
+    
+    sender = asyncio.create_task(send_messages())
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                hub.publish(name, hub_message_data(msg.data))
+    finally:
+        sender.cancel()
+        hub.unsubscribe(name, subscriber)
+    return ws
+
+async def hub_events(request):
+    """
+    Server-Sent Events endpoint of a room. A reconnecting EventSource sends
+    Last-Event-ID and gets the messages it missed from the history.
+    """
+    name = request.match_info["room"]
+    try:
+        since = max(int(request.headers.get("Last-Event-ID") or request.query.get("since") or 0), 0)
+    except ValueError:
+        # Not an ID this hub sent; treat it like a first connection.
+        since = 0
+    try:
+        subscriber = hub.subscribe(name, since)
+    except ValueError as e:
+        return web.Response(status=404, text=str(e))
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-store",
+    })
+    try:
+        await response.prepare(request)
+        while True:
+            try:
+                async with asyncio.timeout(HUB_HEARTBEAT):
+                    message = await subscriber.queue.get()
+            except TimeoutError:
+                # Keep proxies from closing an idle connection.
+                await response.write(b": ping\n\n")
+                continue
+            if message is None:
+                break
+            await response.write(message.event)
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.unsubscribe(name, subscriber)
+    return response
+
+async def hub_publish(request):
+    """
+    Publish the request body (JSON, or text) to a room.
+    """
+    name = request.match_info["room"]
+    text = await request.text()
+    if len(text) > HUB_MAX_MESSAGE:
+        return web.Response(status=413, text="Message too large")
+    try:
+        message_id = hub.publish(name, hub_message_data(text))
+    except ValueError as e:
+        return web.Response(status=404, text=str(e))
+    return web.json_response({"id": message_id})
 
 ###########################################
 # Admin Interface Handlers
@@ -328,6 +3660,7 @@ async def admin_get(request):
       <div style="background:#eee; padding:10px; margin-bottom:10px;">
         <strong>Navigation:</strong> {nav_links}
       </div>
+      <p><a href="/admin/blocking">Event loop stalls</a></p>
       
       <h2>Update Server Name</h2>
       <form action="/admin/update_server" method="POST">
@@ -353,11 +3686,48 @@ async def admin_get(request):
     """
     return web.Response(text=html, content_type="text/html")
 
+async def admin_blocking(request):
+    """
+    Show the recent event loop stalls found by the watchdog, with the page
+    line and stack that caused each one.
+    """
+    offenders = "".join(
+        f"<li>{html.escape(str(page))}: {count}</li>"
+        for page, count in watchdog.offenders.most_common()
+    )
+    reports = ""
+    for report in reversed(watchdog.reports):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(report["started"]))
+        quarantined = " (process pool)" if os.path.join(BASE_DIR, str(report["page"])) in slow_pages else ""
+        reports += f"""
+        <h3>{html.escape(str(report["page"]))} line {report["line"]}: {report["duration"]:.3f}s at {started}{quarantined}</h3>
+        <pre>{html.escape(report["stack"])}</pre>
+        """
+    text = f"""
+    <html>
+    <head>
+      <title>Event Loop Stalls</title>
+    </head>
+    <body>
+      <h1>Event Loop Stalls</h1>
+      <p>Current loop lag: {loop_lag.lag:.3f}s, threshold {BLOCK_THRESHOLD}s.
+      <a href="/admin">Back to the admin panel</a></p>
+      <h2>Offenders</h2>
+      <ul>{offenders or "<li>None so far.</li>"}</ul>
+      <h2>Recent Stalls</h2>
+      {reports}
+    </body>
+    </html>
+    """
+    return web.Response(text=text, content_type="text/html")
+
 async def admin_update_server(request):
     data = await request.post()
     new_name = data.get("server_name", "").strip()
     if new_name:
-        global_config["server_name"] = new_name
+        apply_config({"server_name": new_name})
+        # Let the other worker processes know.
+        broadcast("config", {"server_name": new_name})
     raise web.HTTPFound("/admin")
 
 async def admin_create_page(request):
@@ -372,10 +3742,15 @@ async def admin_create_page(request):
     full_path = os.path.abspath(os.path.join(BASE_DIR, page_name))
     if not full_path.startswith(BASE_DIR):
         return web.Response(text="Invalid page name", status=400)
-    if os.path.exists(full_path):
+    try:
+        st = await fs.run(write_new_file, full_path, page_content.encode("utf-8"))
+    except FileExistsError:
         return web.Response(text="File already exists", status=400)
-    with open(full_path, "w", encoding="utf-8") as f:
-        f.write(page_content)
+    except OSError as e:
+        return web.Response(text=f"Could not create page: {e}", status=500)
+    install_page(full_path, st, page_content)
+    # Let the other worker processes know.
+    broadcast("page", {"op": "create", "path": os.path.relpath(full_path, BASE_DIR)})
     raise web.HTTPFound("/admin")
 
 async def admin_delete_page(request):
@@ -386,10 +3761,46 @@ async def admin_delete_page(request):
     full_path = os.path.abspath(os.path.join(BASE_DIR, rel_path))
     if not full_path.startswith(BASE_DIR):
         return web.Response(text="Invalid file path", status=400)
-    if os.path.exists(full_path) and can_serve_file(full_path):
-        os.remove(full_path)
+    if can_serve_file(full_path):
+        try:
+            await fs.run(os.remove, full_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            return web.Response(text=f"Could not delete page: {e}", status=500)
+        uninstall_page(full_path)
+        broadcast("page", {"op": "delete", "path": os.path.relpath(full_path, BASE_DIR)})
     raise web.HTTPFound("/admin")
 
+def install_page(file_path: str, st, source: str):
+    """
+    Make a page created by the admin handlers servable at once: add it to
+    the route index and compile it from the content just written.
+    """
+    forget_page(file_path)
+    if is_page_file(os.path.basename(file_path)):
+        route_index.add_page(file_path)
+    try:
+        store_page(file_path, file_signature(st), source)
+    except SyntaxError:
+        # Reported when the page is requested.
+        pass
+
+def uninstall_page(file_path: str):
+    route_index.remove_page(file_path)
+    forget_page(file_path)
+
+def apply_page_change(data: dict):
+    # Another worker created or deleted a page; the file is already in place.
+    file_path = os.path.join(BASE_DIR, data["path"])
+    if data["op"] == "create":
+        forget_page(file_path)
+        route_index.add_page(file_path)
+    else:
+        uninstall_page(file_path)
+
+cluster_handlers["page"] = apply_page_change
+
 ###########################################
 # Main Request Handler
 ###########################################
@@ -405,6 +3816,7 @@ async def handle_request(request):
           Prefer page_home.py; if not found, try page_index.py.
     """
     url_path = request.match_info.get("tail", "")
+    st = None
     
     # If no specific path was requested, try to serve the dynamic home page.
     if url_path == "":
@@ -415,8 +3827,9 @@ async def handle_request(request):
             return web.Response(status=404, text="Home page not found.")
     else:
         file_path = resolve_file_path(url_path)
+        st = await fs.stat(file_path) if file_path else None
         # If the static file does not exist, try dynamic page resolution.
-        if not file_path or not os.path.exists(file_path):
+        if st is None:
             file_path = find_dynamic_page(url_path)
             if not file_path:
                 return web.Response(status=404, text="File not found")
@@ -425,38 +3838,79 @@ async def handle_request(request):
         return web.Response(status=403, text="Access Denied")
     
     # If a directory is requested, look for an index file or generate a listing.
-    if os.path.isdir(file_path):
-        index_file = get_index_file(file_path)
+    if st is not None and stat.S_ISDIR(st.st_mode):
+        index_file = await get_index_file(file_path)
         if index_file:
             file_path = index_file
+            st = None
         else:
             rel_dir = os.path.relpath(file_path, BASE_DIR)
-            listing = directory_listing(file_path, rel_dir)
-            return web.Response(text=listing, content_type="text/html")
-    
+            request["route"] = rel_dir
+            return await directory_listing(request, file_path, rel_dir, st)
     ext = os.path.splitext(file_path)[1].lower()
+    request["route"] = os.path.relpath(file_path, BASE_DIR) if ext == ".py" else static_route_label(ext)
     
     # For dynamic pages: only allow .py files that start with "page_"
     if ext == ".py":
         if not os.path.basename(file_path).startswith("page_"):
             return web.Response(status=403, text="Access Denied")
-        context = {
-            "config": global_config,
-            "resources": Resources(),
-            "routes": list(list_dynamic_pages().keys())
-        }
+        # Response headers the page may set, e.g. "Cache-Control".
+        context = PageContext(headers={})
+        if request.query.get("__profile"):
+            if not is_admin_request(request):
+                return web.Response(status=403, text="Access Denied")
+            if not await acquire_route_slot(file_path):
+                return overloaded_response()
+            deadline = asyncio.timeout(RENDER_TIMEOUT)
+            try:
+                async with deadline:
+                    return await profile_page(request, file_path, context)
+            except TimeoutError as e:
+                if deadline.expired():
+                    return web.Response(status=504, text="Page render timed out")
+                return web.Response(status=500, text=f"Error rendering page: {e!r}")
+            except Exception as e:
+                return web.Response(status=500, text=f"Error rendering page: {e}")
+            finally:
+                release_route_slot(file_path)
+        # Only this deadline means a timeout; a TimeoutError raised inside
+        # the page (e.g. by a resource call) is an ordinary error.
+        deadline = asyncio.timeout(RENDER_TIMEOUT)
         try:
-            raw_output, env = await render_page(file_path, context)
-            final_output = await process_template(raw_output, env)
-            return web.Response(text=final_output, content_type="text/html")
+            streaming = STREAM_PAGES or (request.query.get("__stream") == "1" and is_admin_request(request))
+            if streaming and await runs_in_process(file_path):
+                streaming = False
+            etag = None
+            if not streaming:
+                etag = await page_version_etag(file_path, context)
+                if etag is not None and request.if_none_match and etag_matches(request, etag):
+                    headers = dict(page_headers.get(file_path, {}))
+                    headers.pop("Last-Modified", None)
+                    headers["ETag"] = f'"{etag}"'
+                    return web.Response(status=304, headers=headers)
+            if not await acquire_route_slot(file_path):
+                return overloaded_response()
+            try:
+                if streaming:
+                    return await stream_page(request, file_path, context)
+                async with deadline:
+                    final_output = await render_dynamic(file_path, context)
+            finally:
+                release_route_slot(file_path)
+            if file_path in page_versions:
+                page_headers[file_path] = dict(context["headers"])
+            body = final_output.encode("utf-8")
+            return page_response(request, body, etag or body_etag(body), context["headers"])
+        except TimeoutError as e:
+            if deadline.expired():
+                return web.Response(status=504, text="Page render timed out")
+            return web.Response(status=500, text=f"Error rendering page: {e!r}")
         except Exception as e:
             return web.Response(status=500, text=f"Error rendering page: {e}")
     
     elif ext == ".json":
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read()
-            return web.Response(text=content, content_type="application/json")
+            return await serve_static(request, file_path, st=st)
         except Exception as e:
             return web.Response(status=500, text=f"Error reading JSON: {e}")
     
@@ -464,27 +3918,327 @@ async def handle_request(request):
         headers = {
             "Content-Disposition": f"attachment; filename={os.path.basename(file_path)}"
         }
-        return web.FileResponse(file_path, headers=headers)
+        return await serve_static(request, file_path, headers, st)
     
     else:
-        return web.FileResponse(file_path)
+        return await serve_static(request, file_path, st=st)
 
 ###########################################
 # Application Setup & Routes
 ###########################################
 
+async def start_route_watcher(app):
+    create_route_watcher(route_index, asyncio.get_running_loop())
+
+async def stop_route_watcher(app):
+    if route_index.watcher is not None:
+        route_index.watcher.stop()
+        route_index.watcher = None
+
 async def start_server():
-    app = web.Application()
+    middlewares = [admission_middleware, compression_middleware]
+    if METRICS_ENABLED:
+        middlewares.insert(0, metrics_middleware)
+    app = web.Application(middlewares=middlewares)
+    if METRICS_ENABLED:
+        app.on_response_prepare.append(count_response_bytes)
+    
+    # Index the dynamic pages once and keep the index current while serving.
+    route_index.build(BASE_DIR)
+    app.on_startup.append(start_route_watcher)
+    if STATIC_PRECOMPRESS:
+        app.on_startup.append(precompress_on_startup)
+    app.on_startup.append(open_page_cache)
+    app.on_cleanup.append(close_page_cache)
+    app.on_cleanup.append(stop_route_watcher)
+    
+    app.on_startup.append(loop_lag.start)
+    app.on_cleanup.append(loop_lag.stop)
+    if BLOCK_WATCHDOG:
+        app.on_startup.append(watchdog.start)
+        app.on_cleanup.append(watchdog.stop)
+    app.on_cleanup.append(close_database)
+    app.on_cleanup.append(stop_process_pool)
+    app.on_cleanup.append(stop_file_system)
+    if cluster is not None:
+        app.on_startup.append(cluster.start)
+        app.on_cleanup.append(cluster.stop)
     
     # Admin routes.
     app.router.add_get("/admin", admin_get)
     app.router.add_post("/admin/update_server", admin_update_server)
     app.router.add_post("/admin/create_page", admin_create_page)
     app.router.add_post("/admin/delete", admin_delete_page)
+    app.router.add_get("/admin/blocking", admin_blocking)
+    
+    # Pub/sub hub.
+    app.router.add_get("/hub/{room}/ws", hub_websocket)
+    app.router.add_get("/hub/{room}/events", hub_events)
+    app.router.add_post("/hub/{room}", hub_publish)
+    app.on_shutdown.append(close_hub)
+    if METRICS_ENABLED:
+        app.router.add_get("/metrics", metrics_handler)
     
     # Catch-all route.
     app.router.add_route("*", "/{tail:.*}", handle_request)
     return app
 
+###########################################
+# Multi-Process Mode
+###########################################
+
+def make_listening_socket(host, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if host and ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Lets a new supervisor bind the port while the old one drains.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host or "", port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+def run_worker(sock, control):
+    """
+    Body of a forked worker process: serve the shared socket until told to stop.
+    """
+    global cluster
+    signal.set_wakeup_fd(-1)
+    for sig in (signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    cluster = ClusterChannel(control)
+    web.run_app(start_server(), sock=sock, print=None)
+
+class Supervisor:
+    """
+    Pre-fork mode: runs N worker processes that accept on one shared
+    listening socket.
+
+    - A worker that dies is restarted (after a short delay if it crashed
+      right after starting).
+    - SIGHUP does a rolling restart: one new worker is started before each
+      old one is stopped, so capacity never drops.
+    - SIGTERM / SIGINT stop all workers gracefully.
+    - Messages from one worker (see ClusterChannel) are relayed to all the
+      others; configuration updates are also kept here so that restarted
+      workers start with them. Control sockets are non-blocking: messages
+      for a worker that is not reading (e.g. its loop is blocked by a page)
+      wait in a buffer, and a worker more than MAX_BACKLOG bytes behind is
+      restarted instead of stalling the supervisor.
+    """
+    RESTART_DELAY = 1.0
+    STOP_TIMEOUT = 30.0
+    MAX_BACKLOG = 1024 * 1024
+
+    def __init__(self, host, port: int, workers: int):
+        self.sock = make_listening_socket(host, port)
+        self.count = workers
+        # pid -> (control socket, start time, read buffer, write buffer)
+        self.workers = {}
+        self.selector = selectors.DefaultSelector()
+        self.signals = []
+        self.stopping = False
+        self.stop_deadline = None
+        self.respawn_at = []
+        self.rolling = []
+        self.retiring = set()
+
+    def spawn(self):
+        parent_end, child_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for control, *_ in self.workers.values():
+                control.close()
+            try:
+                run_worker(self.sock, child_end)
+            finally:
+                os._exit(0)
+        child_end.close()
+        parent_end.setblocking(False)
+        self.workers[pid] = (parent_end, time.monotonic(), bytearray(), bytearray())
+        self.selector.register(parent_end, selectors.EVENT_READ, pid)
+        return pid
+
+    def run(self):
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        for sig in (signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: self.signals.append(signum))
+        self.selector.register(wakeup_r, selectors.EVENT_READ, None)
+        print(f"======== Running on {self.sock.getsockname()} with {self.count} workers ========")
+        for _ in range(self.count):
+            self.spawn()
+        
+        while self.workers or not self.stopping:
+            for key, events in self.selector.select(timeout=0.5):
+                if key.data is None:
+                    try:
+                        os.read(wakeup_r, 512)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if events & selectors.EVENT_WRITE and key.data in self.workers:
+                    self._flush(key.data)
+                if events & selectors.EVENT_READ and key.data in self.workers:
+                    self._relay(key.data)
+            self._handle_signals()
+            self._reap()
+            now = time.monotonic()
+            while self.respawn_at and self.respawn_at[0] <= now and not self.stopping:
+                self.respawn_at.pop(0)
+                self.spawn()
+            if self.stopping and self.stop_deadline is not None and now > self.stop_deadline:
+                for pid in self.workers:
+                    os.kill(pid, signal.SIGKILL)
+                self.stop_deadline = None
+        self.sock.close()
+
+    def _handle_signals(self):
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                self.stopping = True
+                self.stop_deadline = time.monotonic() + self.STOP_TIMEOUT
+                for pid in self.workers:
+                    os.kill(pid, signal.SIGTERM)
+            elif signum == signal.SIGHUP and not self.stopping and not self.rolling:
+                self.rolling = list(self.workers)
+                self._roll_next()
+
+    def _roll_next(self):
+        """
+        Replace the next old worker: start its successor, then stop it.
+        """
+        if self.retiring or not self.rolling:
+            return
+        old = self.rolling.pop(0)
+        if old not in self.workers:
+            self._roll_next()
+            return
+        self.spawn()
+        self.retiring.add(old)
+        os.kill(old, signal.SIGTERM)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker[0].fileno() != -1:
+                self.selector.unregister(worker[0])
+                worker[0].close()
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                self._roll_next()
+            elif not self.stopping:
+                # A crash: restart it, waiting a little if it died right away.
+                delay = self.RESTART_DELAY if time.monotonic() - worker[1] < self.RESTART_DELAY else 0
+                self.respawn_at.append(time.monotonic() + delay)
+
+    def _relay(self, pid):
+        control, started, buffer, _ = self.workers[pid]
+        if control.fileno() == -1:
+            return
+        try:
+            data = control.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(pid)
+            return
+        buffer.extend(data)
+        while b"\n" in buffer:
+            index = buffer.index(b"\n")
+            line = bytes(buffer[:index + 1])
+            del buffer[:index + 1]
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("op") == "config":
+                # Workers forked later inherit this.
+                global_config.update(message.get("data") or {})
+            for other in list(self.workers):
+                if other != pid:
+                    self._send(other, line)
+
+    def _send(self, pid, line: bytes):
+        control, _, _, pending = self.workers[pid]
+        if control.fileno() == -1:
+            return
+        if len(pending) + len(line) > self.MAX_BACKLOG:
+            print(f"Worker {pid} is not reading cluster messages; restarting it")
+            self._disconnect(pid)
+            os.kill(pid, signal.SIGTERM)
+            return
+        was_empty = not pending
+        pending.extend(line)
+        if was_empty:
+            self._flush(pid)
+
+    def _flush(self, pid):
+        control, _, _, pending = self.workers[pid]
+        if control.fileno() == -1:
+            return
+        try:
+            sent = control.send(pending)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._disconnect(pid)
+            return
+        del pending[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+        self.selector.modify(control, events, pid)
+
+    def _disconnect(self, pid):
+        # The worker closed its channel or is being dropped; _reap() cleans
+        # up the rest when it exits.
+        control, _, _, pending = self.workers[pid]
+        pending.clear()
+        if control.fileno() != -1:
+            self.selector.unregister(control)
+            control.close()
+
+def main(argv=None):
+    global METRICS_ENABLED, PAGE_BYTECODE_CACHE, WARMUP_PAGES, BLOCK_QUARANTINE
+    parser = argparse.ArgumentParser(description="Serve page_*.py files and static content.")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the listening socket")
+    parser.add_argument("--metrics", action="store_true",
+                        help="collect metrics and serve them at /metrics")
+    parser.add_argument("--bytecode-cache", action="store_true",
+                        help=f"keep compiled pages and templates in {PAGE_BYTECODE_DIR} across restarts")
+    parser.add_argument("--warmup", action="store_true",
+                        help="compile all pages before accepting requests")
+    parser.add_argument("--quarantine-blocking", action="store_true",
+                        help="render pages that block the event loop in the process pool")
+    args = parser.parse_args(argv)
+    if args.quarantine_blocking:
+        BLOCK_QUARANTINE = True
+    if args.bytecode_cache:
+        PAGE_BYTECODE_CACHE = True
+    if args.warmup:
+        WARMUP_PAGES = True
+    if args.metrics:
+        METRICS_ENABLED = True
+    if args.workers > 1:
+        Supervisor(args.host, args.port, args.workers).run()
+    else:
+        web.run_app(start_server(), host=args.host, port=args.port)
+
 if __name__ == "__main__":
-    web.run_app(start_server(), port=8000)
+    main()